@@ -3,7 +3,7 @@ import sqlite3
 import json
 import csv
 import asyncio
-from telethon import TelegramClient
+from telethon import TelegramClient, events
 from telethon.tl.types import (
     MessageMediaPhoto, MessageMediaDocument, User, PeerChannel,
     UserStatusRecently, UserStatusLastWeek, 
@@ -16,9 +16,32 @@ import sys
 import shutil
 import logging
 from telethon.sessions import StringSession
+from telethon.utils import get_peer_id
 from telethon.tl.functions.users import GetFullUserRequest
 import time
 import random
+import hashlib
+import heapq
+import io
+import concurrent.futures
+import contextlib
+import copy
+import gzip
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet export is optional and only needs pyarrow when it is used
+    pa = pq = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    # Without zstandard, zstd exports fall back to gzip from the standard library
+    zstd = None
 
 def display_ascii_art():
     WHITE = "\033[97m"
@@ -60,8 +83,11 @@ def load_state():
     }
 
 def save_state(state):
-    with open(STATE_FILE, 'w') as f:
+    # Write to a temporary file and swap it in so a crash never leaves a truncated state file
+    tmp_file = f'{STATE_FILE}.tmp'
+    with open(tmp_file, 'w') as f:
         json.dump(state, f)
+    os.replace(tmp_file, STATE_FILE)
 
 def check_credentials():
     """Check if API credentials exist in state"""
@@ -140,34 +166,681 @@ client = TelegramClient(
     system_lang_code='en'
 )
 
-def save_message_to_db(channel, message, sender):
-    channel_dir = os.path.join(os.getcwd(), channel)
-    os.makedirs(channel_dir, exist_ok=True)
+SQLITE_JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE')
+SQLITE_SYNC_LEVELS = ('OFF', 'NORMAL', 'FULL')
+
+def connect_db(db_file):
+    """Open an archive database with the storage profile from settings
+
+    WAL journaling lets exports and other readers run alongside the
+    scraper, and synchronous=NORMAL under WAL only syncs at checkpoints
+    while staying safe against corruption on a crash.
+    """
+    journal_mode = str(get_setting('storage', 'journal_mode')).upper()
+    synchronous = str(get_setting('storage', 'synchronous')).upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        journal_mode = DEFAULT_SETTINGS['storage']['journal_mode']
+    if synchronous not in SQLITE_SYNC_LEVELS:
+        synchronous = DEFAULT_SETTINGS['storage']['synchronous']
+
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute(f'PRAGMA journal_mode={journal_mode}')
+    conn.execute(f'PRAGMA synchronous={synchronous}')
+    conn.execute(f"PRAGMA mmap_size={int(get_setting('storage', 'mmap_size_mb')) * 1024 * 1024}")
+    # A negative cache_size is measured in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size={-int(get_setting('storage', 'cache_size_mb')) * 1024}")
+    # Rows displaced by INSERT OR REPLACE must fire the delete triggers that keep the search index in step
+    conn.execute('PRAGMA recursive_triggers = ON')
+    return conn
+
+MESSAGE_COLUMNS = ('message_id', 'date', 'sender_id', 'first_name', 'last_name', 'username',
+                   'message', 'media_type', 'media_path', 'reply_to', 'media_status')
+
+class MigrationSkipped(Exception):
+    """Raised by a migration this SQLite build can't run; it is retried whenever the database is opened"""
+
+def skipped_migrations(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'skipped_migrations'").fetchone():
+        return []
+    return [row[0] for row in conn.execute('SELECT version FROM skipped_migrations ORDER BY version')]
+
+def apply_migrations(conn, migrations, db_file):
+    """Bring a database up to the latest schema version
+
+    The schema version is stamped in PRAGMA user_version, and every
+    pending migration runs inside a single transaction, so an interrupted
+    upgrade leaves the database at its previous version. Migrations that
+    raise MigrationSkipped are recorded and run again on a later open.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(migrations) and not skipped_migrations(conn):
+        return
 
-    db_file = os.path.join(channel_dir, f'{channel}.db')
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute(f'''CREATE TABLE IF NOT EXISTS messages
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another connection may have upgraded the database while we waited for the lock
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            retried = skipped_migrations(conn)
+            for number in retried + list(range(version + 1, len(migrations) + 1)):
+                try:
+                    migrations[number - 1](conn, db_file)
+                except MigrationSkipped as e:
+                    if number not in retried:
+                        print(f"Warning: {e}")
+                        conn.execute('CREATE TABLE IF NOT EXISTS skipped_migrations (version INTEGER PRIMARY KEY)')
+                        conn.execute('INSERT INTO skipped_migrations (version) VALUES (?)', (number,))
+                    continue
+                if number in retried:
+                    conn.execute('DELETE FROM skipped_migrations WHERE version = ?', (number,))
+            conn.execute(f'PRAGMA user_version = {len(migrations)}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+def messages_v1_baseline(conn, db_file):
+    """The original per-channel layout with a surrogate id"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages
                   (id INTEGER PRIMARY KEY, message_id INTEGER, date TEXT, sender_id INTEGER, first_name TEXT, last_name TEXT, username TEXT, message TEXT, media_type TEXT, media_path TEXT, reply_to INTEGER)''')
-    c.execute('''INSERT OR IGNORE INTO messages (message_id, date, sender_id, first_name, last_name, username, message, media_type, media_path, reply_to)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (message.id, 
-               message.date.strftime('%Y-%m-%d %H:%M:%S'), 
-               message.sender_id,
-               getattr(sender, 'first_name', None) if isinstance(sender, User) else None, 
-               getattr(sender, 'last_name', None) if isinstance(sender, User) else None,
-               getattr(sender, 'username', None) if isinstance(sender, User) else None,
-               message.message, 
-               message.media.__class__.__name__ if message.media else None, 
-               None,
-               message.reply_to_msg_id if message.reply_to else None))
-    conn.commit()
-    conn.close()
+    conn.execute('''CREATE TABLE IF NOT EXISTS checkpoints
+                  (channel TEXT PRIMARY KEY, last_message_id INTEGER, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def messages_v2_media_status(conn, db_file):
+    """Track background media downloads per message"""
+    if 'media_status' not in table_columns(conn, 'messages'):
+        conn.execute('ALTER TABLE messages ADD COLUMN media_status TEXT')
+
+def messages_v3_keyed_layout(conn, db_file):
+    """Rebuild the table keyed on message_id, removing duplicate rows
+
+    The old surrogate id never made INSERT OR IGNORE ignore anything, so
+    re-scrapes appended duplicates; one row per message is kept,
+    preferring one with downloaded media and then the most recently
+    written. message_id becomes the table's clustered key.
+    """
+    if 'id' not in table_columns(conn, 'messages'):
+        return
+
+    before = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    if before:
+        print(f"Migrating {db_file} to the keyed message layout...")
+    column_list = ', '.join(MESSAGE_COLUMNS)
+    conn.execute('''CREATE TABLE messages_keyed
+                  (message_id INTEGER PRIMARY KEY, date TEXT, sender_id INTEGER, first_name TEXT, last_name TEXT, username TEXT, message TEXT, media_type TEXT, media_path TEXT, reply_to INTEGER, media_status TEXT)''')
+    conn.execute(f'''INSERT OR IGNORE INTO messages_keyed ({column_list})
+                     SELECT {column_list} FROM messages
+                     WHERE message_id IS NOT NULL
+                     ORDER BY media_path IS NULL, id DESC''')
+    after = conn.execute('SELECT COUNT(*) FROM messages_keyed').fetchone()[0]
+    conn.execute('DROP TABLE messages')
+    conn.execute('ALTER TABLE messages_keyed RENAME TO messages')
+    if before:
+        print(f"Removed {before - after} duplicate row(s), {after} message(s) kept")
+
+def fts5_available(conn):
+    return bool(conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+
+def messages_v4_search_index(conn, db_file):
+    """Full-text index over message text, kept current by triggers
+
+    The index is an external-content FTS5 table keyed on message_id, so
+    the text is stored only once, in messages.
+    """
+    if not fts5_available(conn):
+        raise MigrationSkipped(f"this SQLite build has no FTS5 support; {db_file} will not be searchable")
+
+    conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', content_rowid='message_id')")
+    conn.execute('''CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                      INSERT INTO messages_fts (rowid, message) VALUES (new.message_id, new.message);
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.message_id, old.message);
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.message_id, old.message);
+                      INSERT INTO messages_fts (rowid, message) VALUES (new.message_id, new.message);
+                    END''')
+    if conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+        print(f"Building the search index for {db_file}...")
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def messages_v5_export_watermarks(conn, db_file):
+    """How far each incremental export of a channel has got, per output"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS export_watermarks
+                  (channel TEXT NOT NULL, export TEXT NOT NULL, last_message_id INTEGER, byte_offset INTEGER, rows INTEGER,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (channel, export))''')
+
+def messages_v6_secondary_indexes(conn, db_file):
+    """Indexes for date-range, sender, reply and media type lookups
+
+    The partial index covers only messages whose media has not been
+    downloaded, which is exactly what rescrape_media selects.
+    """
+    if conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+        print(f"Indexing {db_file}...")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_reply_to ON messages (reply_to)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_media_type ON messages (media_type)')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_media_pending ON messages (message_id)
+                    WHERE media_path IS NULL AND media_type IS NOT NULL''')
+    # Sampled statistics let the planner prefer the small partial index for media lookups
+    conn.execute('PRAGMA analysis_limit = 1000')
+    conn.execute('ANALYZE messages')
+
+def messages_v7_watermark_fingerprint(conn, db_file):
+    """Fingerprint of the output bytes each export watermark points after"""
+    conn.execute('ALTER TABLE export_watermarks ADD COLUMN fingerprint TEXT')
+
+def messages_v8_media_pending_index(conn, db_file):
+    """Partial index whose condition matches the rescrape_media query, so the planner can use it"""
+    conn.execute('DROP INDEX IF EXISTS idx_messages_media_pending')
+    conn.execute('''CREATE INDEX idx_messages_media_pending ON messages (message_id)
+                    WHERE media_path IS NULL AND media_type IN ('MessageMediaPhoto', 'MessageMediaDocument')''')
+
+# Ordered schema history of channel message databases; append new steps, never edit old ones
+MESSAGES_MIGRATIONS = [
+    messages_v1_baseline,
+    messages_v2_media_status,
+    messages_v3_keyed_layout,
+    messages_v4_search_index,
+    messages_v5_export_watermarks,
+    messages_v6_secondary_indexes,
+    messages_v7_watermark_fingerprint,
+    messages_v8_media_pending_index,
+]
+
+def users_v1_baseline(conn, db_file):
+    """Channel member details collected by Get User Details and GOD Mode"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                (user_id INTEGER PRIMARY KEY,
+                 username TEXT,
+                 first_name TEXT,
+                 last_name TEXT,
+                 phone TEXT,
+                 is_bot BOOLEAN,
+                 is_verified BOOLEAN,
+                 is_restricted BOOLEAN,
+                 is_scam BOOLEAN,
+                 is_fake BOOLEAN,
+                 date_joined TIMESTAMP,
+                 status TEXT,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+USERS_MIGRATIONS = [
+    users_v1_baseline,
+]
+
+def media_index_v1_baseline(conn, db_file):
+    """Shared media store index keyed by Telegram file identity"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS media_files
+                  (file_key TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, path TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_files_sha256 ON media_files (sha256)')
+
+MEDIA_INDEX_MIGRATIONS = [
+    media_index_v1_baseline,
+]
+
+def archive_v1_baseline(conn, db_file):
+    """Every channel's messages in one database, partitioned by channel"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                  (channel TEXT NOT NULL, message_id INTEGER NOT NULL, date TEXT, sender_id INTEGER, first_name TEXT, last_name TEXT, username TEXT, message TEXT, media_type TEXT, media_path TEXT, reply_to INTEGER, media_status TEXT,
+                   PRIMARY KEY (channel, message_id)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS checkpoints
+                  (channel TEXT PRIMARY KEY, last_message_id INTEGER, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+def archive_v2_search_index(conn, db_file):
+    """Full-text index over message text in the consolidated archive
+
+    The WITHOUT ROWID messages table has no integer key for an
+    external-content index, so the index keeps its own copy of the text
+    with channel and message_id as unindexed columns, and
+    messages_fts_rowids maps each message to its index row so triggers
+    can update it without scanning.
+    """
+    if not fts5_available(conn):
+        raise MigrationSkipped(f"this SQLite build has no FTS5 support; {db_file} will not be searchable")
+
+    conn.execute('CREATE VIRTUAL TABLE messages_fts USING fts5(message, channel UNINDEXED, message_id UNINDEXED)')
+    conn.execute('''CREATE TABLE messages_fts_rowids
+                  (channel TEXT NOT NULL, message_id INTEGER NOT NULL, fts_rowid INTEGER NOT NULL,
+                   PRIMARY KEY (channel, message_id)) WITHOUT ROWID''')
+    conn.execute('''CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                      INSERT INTO messages_fts (message, channel, message_id) VALUES (new.message, new.channel, new.message_id);
+                      INSERT OR REPLACE INTO messages_fts_rowids (channel, message_id, fts_rowid)
+                      VALUES (new.channel, new.message_id, last_insert_rowid());
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                      DELETE FROM messages_fts WHERE rowid = (SELECT fts_rowid FROM messages_fts_rowids
+                                                              WHERE channel = old.channel AND message_id = old.message_id);
+                      DELETE FROM messages_fts_rowids WHERE channel = old.channel AND message_id = old.message_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                      UPDATE messages_fts SET message = new.message
+                      WHERE rowid = (SELECT fts_rowid FROM messages_fts_rowids
+                                     WHERE channel = new.channel AND message_id = new.message_id);
+                    END''')
+    if conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+        print(f"Building the search index for {db_file}...")
+        conn.execute('INSERT INTO messages_fts (message, channel, message_id) SELECT message, channel, message_id FROM messages')
+        conn.execute('''INSERT INTO messages_fts_rowids (channel, message_id, fts_rowid)
+                        SELECT channel, message_id, rowid FROM messages_fts''')
+
+def archive_v3_export_watermarks(conn, db_file):
+    """The messages_v5_export_watermarks table, which is already keyed by channel"""
+    messages_v5_export_watermarks(conn, db_file)
+
+def archive_v4_secondary_indexes(conn, db_file):
+    """The messages_v6_secondary_indexes set, each index leading with channel"""
+    if conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+        print(f"Indexing {db_file}...")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (channel, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (channel, sender_id, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_reply_to ON messages (channel, reply_to)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_media_type ON messages (channel, media_type)')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_media_pending ON messages (channel, message_id)
+                    WHERE media_path IS NULL AND media_type IS NOT NULL''')
+    conn.execute('PRAGMA analysis_limit = 1000')
+    conn.execute('ANALYZE messages')
+
+def archive_v5_watermark_fingerprint(conn, db_file):
+    """The messages_v7_watermark_fingerprint column"""
+    messages_v7_watermark_fingerprint(conn, db_file)
+
+def archive_v6_media_pending_index(conn, db_file):
+    """The messages_v8_media_pending_index index, leading with channel"""
+    conn.execute('DROP INDEX IF EXISTS idx_messages_media_pending')
+    conn.execute('''CREATE INDEX idx_messages_media_pending ON messages (channel, message_id)
+                    WHERE media_path IS NULL AND media_type IN ('MessageMediaPhoto', 'MessageMediaDocument')''')
+
+# Schema history of the consolidated archive database
+ARCHIVE_MIGRATIONS = [
+    archive_v1_baseline,
+    archive_v2_search_index,
+    archive_v3_export_watermarks,
+    archive_v4_secondary_indexes,
+    archive_v5_watermark_fingerprint,
+    archive_v6_media_pending_index,
+]
+
+STORAGE_LAYOUTS = ('per_channel', 'consolidated')
+
+def storage_layout(layout=None):
+    return layout or get_setting('storage', 'layout')
+
+def channel_db_path(channel, layout=None):
+    """Path of the database holding a channel's messages in the given (or configured) layout"""
+    if storage_layout(layout) == 'consolidated':
+        return os.path.abspath(get_setting('paths', 'archive_db'))
+    return os.path.join(os.getcwd(), channel, f'{channel}.db')
+
+def channel_scope(channel, layout=None):
+    """SQL condition and parameters selecting one channel's rows from a messages table"""
+    if storage_layout(layout) == 'consolidated':
+        return 'channel = ?', (channel,)
+    return '1', ()
+
+def open_channel_db(channel, layout=None):
+    """Open the database holding a channel's messages, creating it and upgrading its schema if needed"""
+    db_file = channel_db_path(channel, layout)
+    if storage_layout(layout) == 'consolidated':
+        conn = connect_db(db_file)
+        apply_migrations(conn, ARCHIVE_MIGRATIONS, db_file)
+        return conn
+
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    conn = connect_db(db_file)
+    apply_migrations(conn, MESSAGES_MIGRATIONS, db_file)
+    return conn
+
+def open_users_db(db_file):
+    """Open a users database, upgrading its schema if needed"""
+    conn = connect_db(db_file)
+    apply_migrations(conn, USERS_MIGRATIONS, db_file)
+    return conn
+
+def read_checkpoint(channel):
+    """Return the last message id committed to a channel's database, or 0 if none"""
+    if not os.path.exists(channel_db_path(channel)):
+        return 0
+    conn = open_channel_db(channel)
+    try:
+        row = conn.execute('SELECT last_message_id FROM checkpoints WHERE channel = ?', (channel,)).fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+last_state_checkpoint = 0.0
+
+def record_progress(channel, message_id, force=False):
+    """Mirror a committed checkpoint into state.json, coalesced to one write per checkpoint_interval"""
+    global last_state_checkpoint
+    state['channels'][channel] = message_id
+    now = time.monotonic()
+    if force or now - last_state_checkpoint >= get_setting('storage', 'checkpoint_interval'):
+        save_state(state)
+        last_state_checkpoint = now
+
+def build_upsert_sql(partition_columns=()):
+    """Upsert for a messages row, optionally prefixed by partition columns
+
+    Re-scraping a message refreshes its text and sender details but never
+    forgets media that has already been downloaded.
+    """
+    columns = partition_columns + MESSAGE_COLUMNS
+    return f'''INSERT INTO messages ({', '.join(columns)})
+    VALUES ({', '.join('?' for _ in columns)})
+    ON CONFLICT({', '.join(partition_columns + ('message_id',))}) DO UPDATE SET
+        date = excluded.date, sender_id = excluded.sender_id, first_name = excluded.first_name,
+        last_name = excluded.last_name, username = excluded.username, message = excluded.message,
+        media_type = excluded.media_type, reply_to = excluded.reply_to,
+        media_path = COALESCE(excluded.media_path, messages.media_path),
+        media_status = COALESCE(CASE WHEN excluded.media_path IS NOT NULL THEN excluded.media_status END,
+                                messages.media_status, excluded.media_status)'''
+
+UPSERT_MESSAGE_SQL = build_upsert_sql()
+ARCHIVE_UPSERT_MESSAGE_SQL = build_upsert_sql(('channel',))
+
+def wants_media_download(message):
+    """Check if a message carries media that download_media can fetch"""
+    return bool(state.get('scrape_media', True)) and isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument))
+
+def message_to_row(message, sender, media_path=None, media_status=None):
+    """Build a messages row in MESSAGE_COLUMNS order"""
+    return (message.id,
+            message.date.strftime('%Y-%m-%d %H:%M:%S'),
+            message.sender_id,
+            getattr(sender, 'first_name', None) if isinstance(sender, User) else None,
+            getattr(sender, 'last_name', None) if isinstance(sender, User) else None,
+            getattr(sender, 'username', None) if isinstance(sender, User) else None,
+            message.message,
+            message.media.__class__.__name__ if message.media else None,
+            media_path,
+            message.reply_to_msg_id if message.reply_to else None,
+            media_status)
+
+class MessageWriter:
+    """Buffers message rows for one channel and commits them in batches over a single connection
+
+    With track_checkpoint off, rows are committed without moving the
+    channel checkpoint; live mode uses this while a catch-up scrape may
+    still be filling a gap below the messages it receives.
+    """
+
+    def __init__(self, channel, batch_size=None, flush_interval_ms=None, media_pool=None, track_checkpoint=True):
+        self.channel = channel
+        self.track_checkpoint = track_checkpoint
+        self.batch_size = batch_size or get_setting('storage', 'write_batch_size')
+        self.flush_interval = (flush_interval_ms or get_setting('storage', 'flush_interval_ms')) / 1000
+        self.media_pool = media_pool
+        self.consolidated = storage_layout() == 'consolidated'
+        self.conn = open_channel_db(channel)
+        self.rows = []
+        self.last_message_id = None
+        self.pending_media = []
+        self.last_flush = time.monotonic()
+
+    def add(self, message, sender, media_path=None):
+        """Buffer a message; returns the last committed message id if this triggered a flush"""
+        if media_path:
+            media_status = 'done'
+        elif wants_media_download(message):
+            media_status = 'pending'
+            if self.media_pool:
+                self.pending_media.append(message)
+        else:
+            media_status = None
+        row = message_to_row(message, sender, media_path, media_status)
+        self.rows.append((self.channel,) + row if self.consolidated else row)
+        self.last_message_id = message.id
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Write all buffered rows in one transaction and return the checkpointed message id, if any"""
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return None
+
+        last_message_id = self.last_message_id
+        # The checkpoint commits in the same transaction as the rows it covers,
+        # so a resume always starts exactly after the last committed batch
+        with self.conn:
+            if self.pending_media:
+                # A catch-up rereads messages live mode already stored; don't download their media a second time
+                scope, scope_params = channel_scope(self.channel)
+                ids = [message.id for message in self.pending_media]
+                queued = {row[0] for row in self.conn.execute(
+                    f'''SELECT message_id FROM messages WHERE {scope} AND message_id BETWEEN ? AND ?
+                         AND (media_path IS NOT NULL OR media_status = 'pending')''',
+                    scope_params + (min(ids), max(ids)))}
+                self.pending_media = [message for message in self.pending_media if message.id not in queued]
+            self.conn.executemany(ARCHIVE_UPSERT_MESSAGE_SQL if self.consolidated else UPSERT_MESSAGE_SQL, self.rows)
+            if self.track_checkpoint:
+                self.conn.execute('''INSERT OR REPLACE INTO checkpoints (channel, last_message_id, updated_at)
+                                     VALUES (?, ?, CURRENT_TIMESTAMP)''', (self.channel, last_message_id))
+
+        self.rows = []
+
+        # Downloads are only queued once their rows exist to receive the media_path
+        for message in self.pending_media:
+            self.media_pool.submit(self.channel, message)
+        self.pending_media = []
+        return last_message_id if self.track_checkpoint else None
+
+    def close(self):
+        """Flush any remaining rows and close the connection"""
+        try:
+            return self.flush()
+        finally:
+            # Refresh planner statistics if the tables have grown enough to need it
+            self.conn.execute('PRAGMA optimize')
+            self.conn.close()
+
+def convert_storage_layout(target):
+    """Copy every channel's messages and checkpoint into the target layout and switch to it
+
+    The source databases are left in place so the conversion can be
+    checked (or repeated) before they are removed by hand.
+    """
+    source = storage_layout()
+    if target == source:
+        print(f"Storage is already using the {target} layout.")
+        return
+
+    channels = list(state['channels'])
+    archive_file = channel_db_path(None, 'consolidated')
+    if source == 'consolidated' and os.path.exists(archive_file):
+        conn = open_channel_db(None, 'consolidated')
+        channels += [row[0] for row in conn.execute('SELECT DISTINCT channel FROM messages') if row[0] not in channels]
+        conn.close()
+
+    column_list = ', '.join(MESSAGE_COLUMNS)
+    converted = 0
+    for channel in channels:
+        source_file = channel_db_path(channel, source)
+        if not os.path.exists(source_file):
+            continue
+        # Bring the source schema up to date before copying from it
+        conn = open_channel_db(channel, source)
+        scope, scope_params = channel_scope(channel, source)
+        has_rows = conn.execute(f'SELECT 1 FROM messages WHERE {scope} LIMIT 1', scope_params).fetchone()
+        conn.close()
+        if not has_rows:
+            continue
+
+        conn = open_channel_db(channel, target)
+        conn.execute('ATTACH DATABASE ? AS source', (source_file,))
+        try:
+            with conn:
+                if target == 'consolidated':
+                    cursor = conn.execute(f'''INSERT OR REPLACE INTO main.messages (channel, {column_list})
+                                             SELECT ?, {column_list} FROM source.messages''', (channel,))
+                else:
+                    cursor = conn.execute(f'''INSERT OR REPLACE INTO main.messages ({column_list})
+                                             SELECT {column_list} FROM source.messages WHERE {scope}''', scope_params)
+                conn.execute('''INSERT OR REPLACE INTO main.checkpoints (channel, last_message_id, updated_at)
+                                SELECT channel, last_message_id, updated_at FROM source.checkpoints
+                                WHERE channel = ?''', (channel,))
+                # Exports keep appending to the same files, so their watermarks move with the messages
+                conn.execute('''INSERT OR REPLACE INTO main.export_watermarks
+                                (channel, export, last_message_id, byte_offset, rows, updated_at, fingerprint)
+                                SELECT channel, export, last_message_id, byte_offset, rows, updated_at, fingerprint
+                                FROM source.export_watermarks WHERE channel = ?''', (channel,))
+            print(f"Converted channel {channel}: {cursor.rowcount} message(s)")
+            converted += 1
+        except sqlite3.Error as e:
+            print(f"Error converting channel {channel}: {e}")
+            print("Conversion stopped; the storage layout was not changed.")
+            return
+        finally:
+            conn.execute('DETACH DATABASE source')
+            conn.close()
+
+    settings = load_settings()
+    settings.setdefault('storage', {})['layout'] = target
+    save_settings(settings)
+    print(f"\nConverted {converted} channel(s) to the {target} layout.")
+    print(f"The {source} database files were kept; remove them once you have checked the result.")
+
+SENDER_CACHE_SIZE = 5000
+SENDER_LOOKUP_BATCH = 100
+
+class SenderCache:
+    """Bounded LRU cache of message senders keyed by sender_id"""
+
+    def __init__(self, capacity=SENDER_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.page_fills = 0
+        self.fetched = 0
+
+    def put(self, sender_id, sender):
+        self.entries[sender_id] = sender
+        self.entries.move_to_end(sender_id)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.page_fills + self.fetched
+        return (self.hits / lookups * 100) if lookups else 0.0
+
+    async def resolve(self, messages):
+        """Return the sender of each message in a history page
+
+        Senders are served from the cache first, then from the users/chats
+        that arrived with the page, and only the remaining ids are fetched,
+        in batched lookups rather than one request per message.
+        """
+        resolved = {}
+        missing = {}
+        for message in messages:
+            sender_id = message.sender_id
+            if sender_id is None or sender_id in resolved or sender_id in missing:
+                continue
+            if sender_id in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(sender_id)
+                resolved[sender_id] = self.entries[sender_id]
+            elif message.sender is not None:
+                self.page_fills += 1
+                self.put(sender_id, message.sender)
+                resolved[sender_id] = message.sender
+            else:
+                missing[sender_id] = message
+
+        missing_ids = list(missing)
+        for i in range(0, len(missing_ids), SENDER_LOOKUP_BATCH):
+            batch = []
+            unknown = []
+            for sender_id in missing_ids[i:i + SENDER_LOOKUP_BATCH]:
+                try:
+                    await client.get_input_entity(sender_id)
+                    batch.append(sender_id)
+                except ValueError:
+                    # Not in the session cache, so it would fail the whole batch
+                    unknown.append(sender_id)
+            try:
+                senders = await client.get_entity(batch) if batch else []
+            except (ValueError, RPCError):
+                unknown = batch + unknown
+                batch, senders = [], []
+            # Telethon's per-message lookup, only for the ids that can't be batched
+            for sender_id in unknown:
+                batch.append(sender_id)
+                senders.append(await missing[sender_id].get_sender())
+            for sender_id, sender in zip(batch, senders):
+                self.fetched += 1
+                if sender is not None:
+                    self.put(sender_id, sender)
+                resolved[sender_id] = sender
+
+        return [resolved.get(message.sender_id) for message in messages]
+
+sender_cache = SenderCache()
 
 MAX_RETRIES = 5
+# Telegram serves file ranges at offsets aligned to the request size, and a
+# request may not cross a 1 MB boundary, so both sizes divide 1 MB evenly
+DOWNLOAD_REQUEST_SIZE = 512 * 1024
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+
+async def download_document_in_parts(message, media_path):
+    """Download a large document as parallel byte ranges written into a preallocated file"""
+    size = message.file.size
+    connections = max(1, int(get_setting('limits', 'download_connections')))
+    semaphore = asyncio.Semaphore(connections)
+    tmp_path = f'{media_path}.part'
+
+    with open(tmp_path, 'wb') as f:
+        f.truncate(size)
+
+    async def fetch_range(offset):
+        async with semaphore:
+            expected = min(DOWNLOAD_PART_SIZE, size - offset)
+            position = offset
+            with open(tmp_path, 'r+b') as f:
+                async for chunk in client.iter_download(message.media, offset=offset,
+                                                        request_size=DOWNLOAD_REQUEST_SIZE,
+                                                        limit=DOWNLOAD_PART_SIZE // DOWNLOAD_REQUEST_SIZE,
+                                                        file_size=size):
+                    f.seek(position)
+                    f.write(chunk[:offset + expected - position])
+                    position += len(chunk)
+            if position - offset < expected:
+                raise IOError(f"Range at offset {offset} ended after {position - offset} of {expected} bytes")
+            return expected
+
+    tasks = [asyncio.ensure_future(fetch_range(offset)) for offset in range(0, size, DOWNLOAD_PART_SIZE)]
+    try:
+        # The file was preallocated, so its size proves nothing; count what the ranges received
+        received = sum(await asyncio.gather(*tasks))
+        if received != size:
+            raise IOError(f"Downloaded {received} bytes, expected {size}")
+        os.replace(tmp_path, media_path)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return media_path
 
 async def download_media(channel, message):
-    if not message.media or not state['scrape_media']:
+    if not message.media or not state.get('scrape_media', True):
         return None
 
     channel_dir = os.path.join(os.getcwd(), channel)
@@ -189,191 +862,1476 @@ async def download_media(channel, message):
         print(f"Media file already exists: {media_path}")
         return media_path
 
+    if get_setting('storage', 'dedupe_media'):
+        file_key = media_file_key(message)
+        if file_key:
+            return await get_media_store().fetch(message, file_key, media_path)
+
+    return await fetch_media(message, media_path, media_folder)
+
+async def fetch_media(message, media_path, download_target):
+    """Download a message's media with retries; download_target is a folder or a full file path"""
     retries = 0
     while retries < MAX_RETRIES:
         try:
+            threshold = get_setting('limits', 'large_file_threshold_mb') * 1024 * 1024
             if isinstance(message.media, MessageMediaPhoto):
-                media_path = await message.download_media(file=media_folder)
+                media_path = await message.download_media(file=download_target)
+            elif isinstance(message.media, MessageMediaDocument) and (message.file.size or 0) >= threshold:
+                media_path = await download_document_in_parts(message, media_path)
             elif isinstance(message.media, MessageMediaDocument):
-                media_path = await message.download_media(file=media_folder)
+                media_path = await message.download_media(file=download_target)
             if media_path:
                 print(f"Successfully downloaded media to: {media_path}")
             break
-        except (TimeoutError, aiohttp.ClientError, RPCError) as e:
+        except (OSError, aiohttp.ClientError, RPCError) as e:
             retries += 1
             print(f"Retrying download for message {message.id}. Attempt {retries}...")
             await asyncio.sleep(2 ** retries)
     return media_path
 
+def media_file_key(message):
+    """Telegram's stable identity for a message's file, shared by every forward of it"""
+    if isinstance(message.media, MessageMediaPhoto) and getattr(message.media, 'photo', None):
+        return f'photo-{message.media.photo.id}'
+    if isinstance(message.media, MessageMediaDocument) and getattr(message.media, 'document', None):
+        return f'document-{message.media.document.id}'
+    return None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def link_media(store_path, media_path):
+    """Expose a stored file in a channel's media folder without copying it where possible"""
+    if os.path.exists(media_path):
+        return
+    try:
+        os.link(store_path, media_path)
+    except OSError:
+        # Hard links fail across filesystems; fall back to a symlink, then a copy
+        try:
+            os.symlink(os.path.abspath(store_path), media_path)
+        except OSError:
+            shutil.copy2(store_path, media_path)
+
+class MediaStore:
+    """Content-addressed media shared by all channels
+
+    Files are keyed by Telegram's file identity so a forward that is
+    already stored is linked into the channel's media folder instead of
+    downloaded again; a content hash taken after each download also
+    catches identical files that arrive under different ids.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        db_file = os.path.join(root, 'index.db')
+        self.conn = connect_db(db_file)
+        apply_migrations(self.conn, MEDIA_INDEX_MIGRATIONS, db_file)
+        self.locks = {}
+        self.downloaded = 0
+        self.reused = 0
+        self.bytes_saved = 0
+
+    def _existing_path(self, column, value):
+        row = self.conn.execute(f'SELECT path FROM media_files WHERE {column} = ?', (value,)).fetchone()
+        return row[0] if row and os.path.exists(row[0]) else None
+
+    async def fetch(self, message, file_key, media_path):
+        """Link a message's file into media_path, downloading it only if the store lacks it"""
+        lock = self.locks.setdefault(file_key, asyncio.Lock())
+        async with lock:
+            store_path = self._existing_path('file_key', file_key)
+            if store_path:
+                self.reused += 1
+                self.bytes_saved += os.path.getsize(store_path)
+            else:
+                ext = os.path.splitext(media_path)[1]
+                target = os.path.join(self.root, file_key[-2:], f'{file_key}{ext}')
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                store_path = await fetch_media(message, target, target)
+                if not store_path or not os.path.exists(store_path):
+                    return None
+
+                loop = asyncio.get_event_loop()
+                sha256 = await loop.run_in_executor(None, file_sha256, store_path)
+                duplicate = self._existing_path('sha256', sha256)
+                if duplicate and duplicate != store_path:
+                    os.remove(store_path)
+                    store_path = duplicate
+                with self.conn:
+                    self.conn.execute('''INSERT OR REPLACE INTO media_files (file_key, sha256, size, path)
+                                         VALUES (?, ?, ?, ?)''', (file_key, sha256, os.path.getsize(store_path), store_path))
+                self.downloaded += 1
+        self.locks.pop(file_key, None)
+
+        link_media(store_path, media_path)
+        return media_path
+
+    def report(self):
+        print(f"Media store: {self.downloaded} downloaded, {self.reused} reused "
+              f"({self.bytes_saved / (1024 * 1024):.1f} MB not re-downloaded)")
+
+media_store = None
+
+def get_media_store():
+    """Return the shared media store, opening it on first use"""
+    global media_store
+    if media_store is None:
+        media_store = MediaStore(get_setting('paths', 'media_store'))
+    return media_store
+
+class MediaDownloadPool:
+    """Bounded pool of background media downloads shared by every channel
+
+    Message rows are committed with media_status 'pending' and their
+    downloads are queued here, so a large file never holds up text
+    archiving. When the queue is full the row simply stays pending for
+    rescrape_media to pick up later.
+    """
+
+    def __init__(self, workers=None, queue_size=None):
+        self.worker_count = max(1, int(workers or get_setting('limits', 'media_workers')))
+        self.queue = asyncio.Queue(maxsize=queue_size or get_setting('limits', 'media_queue_size'))
+        self.workers = []
+        self.connections = {}
+        self.completed = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self._worker()) for _ in range(self.worker_count)]
+
+    def submit(self, channel, message):
+        self.start()
+        try:
+            self.queue.put_nowait((channel, message))
+        except asyncio.QueueFull:
+            self.deferred += 1
+
+    async def _worker(self):
+        while True:
+            channel, message = await self.queue.get()
+            try:
+                media_path = await download_media(channel, message)
+                if media_path and os.path.exists(media_path):
+                    self._store(channel, message.id, media_path, 'done')
+                    self.completed += 1
+                else:
+                    self._store(channel, message.id, None, 'failed')
+                    self.failed += 1
+            except Exception as e:
+                print(f"Error downloading media for message {message.id} in channel {channel}: {e}")
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    def _store(self, channel, message_id, media_path, media_status):
+        db_file = channel_db_path(channel)
+        conn = self.connections.get(db_file)
+        if conn is None:
+            conn = self.connections[db_file] = open_channel_db(channel)
+        scope, scope_params = channel_scope(channel)
+        with conn:
+            conn.execute(f'UPDATE messages SET media_path = ?, media_status = ? WHERE {scope} AND message_id = ?',
+                         (media_path, media_status) + scope_params + (message_id,))
+
+    async def drain(self):
+        """Wait for every queued download to finish"""
+        if self.queue.qsize():
+            print(f"\nWaiting for {self.queue.qsize()} queued media download(s)...")
+        await self.queue.join()
+
+    async def stop(self):
+        """Cancel the workers and close their database connections"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+    def report(self):
+        print(f"Media downloads: {self.completed} completed, {self.failed} failed, "
+              f"{self.queue.qsize()} queued, {self.deferred} left pending for Rescrape Media")
+        if media_store:
+            media_store.report()
+
+media_pool = None
+
+def get_media_pool():
+    """Return the shared media download pool, creating it on first use"""
+    global media_pool
+    if media_pool is None:
+        media_pool = MediaDownloadPool()
+    return media_pool
+
+# channels.getMessages accepts at most 100 ids per request
+RESCRAPE_ID_BATCH = 100
+
 async def rescrape_media(channel):
-    channel_dir = os.path.join(os.getcwd(), channel)
-    db_file = os.path.join(channel_dir, f'{channel}.db')
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute('SELECT message_id FROM messages WHERE media_type IS NOT NULL AND media_path IS NULL')
-    rows = c.fetchall()
-    conn.close()
-
-    total_messages = len(rows)
+    """Download media that is still missing from a channel's database"""
+    if not os.path.exists(channel_db_path(channel)):
+        print(f"No database found for channel {channel}.")
+        return
+
+    conn = open_channel_db(channel)
+    scope, scope_params = channel_scope(channel)
+    rows = conn.execute(f'''SELECT message_id FROM messages
+                            WHERE {scope} AND media_type IN ('MessageMediaPhoto', 'MessageMediaDocument')
+                              AND media_path IS NULL AND (media_status IS NULL OR media_status != 'missing')
+                            ORDER BY message_id''', scope_params).fetchall()
+    message_ids = [row[0] for row in rows]
+
+    total_messages = len(message_ids)
     if total_messages == 0:
         print(f"No media files to reprocess for channel {channel}.")
+        conn.close()
         return
 
-    for index, (message_id,) in enumerate(rows):
-        try:
-            entity = await client.get_entity(PeerChannel(int(channel)))
-            message = await client.get_messages(entity, ids=message_id)
-            media_path = await download_media(channel, message)
-            if media_path:
-                conn = sqlite3.connect(db_file)
-                c = conn.cursor()
-                c.execute('''UPDATE messages SET media_path = ? WHERE message_id = ?''', (media_path, message_id))
-                conn.commit()
-                conn.close()
-            
-            progress = (index + 1) / total_messages * 100
-            sys.stdout.write(f"\rReprocessing media for channel {channel}: {progress:.2f}% complete")
-            sys.stdout.flush()
-        except Exception as e:
-            print(f"Error reprocessing message {message_id}: {e}")
-    print()
+    entity = await get_entity_info(channel)
+    if not entity:
+        conn.close()
+        return
+
+    semaphore = asyncio.Semaphore(max(1, int(get_setting('limits', 'media_workers'))))
+    write_batch_size = get_setting('storage', 'write_batch_size')
+    updates = []
+    pending = set()
+    processed = 0
+
+    def flush_updates():
+        if updates:
+            with conn:
+                conn.executemany(f'UPDATE messages SET media_path = ?, media_status = ? WHERE {scope} AND message_id = ?',
+                                 [(media_path, media_status) + scope_params + (message_id,)
+                                  for media_path, media_status, message_id in updates])
+            updates.clear()
+
+    def mark_done(count=1):
+        nonlocal processed
+        processed += count
+        progress = processed / total_messages * 100
+        sys.stdout.write(f"\rReprocessing media for channel {channel}: {progress:.2f}% complete")
+        sys.stdout.flush()
+
+    async def rescrape(message):
+        async with semaphore:
+            try:
+                media_path = await download_media(channel, message)
+                if media_path and os.path.exists(media_path):
+                    updates.append((media_path, 'done', message.id))
+                else:
+                    updates.append((None, 'failed', message.id))
+            except Exception as e:
+                print(f"\nError reprocessing message {message.id}: {e}")
+        mark_done()
 
-async def scrape_channel(channel, offset_id):
     try:
-        if channel.startswith('-'):
-            entity = await client.get_entity(PeerChannel(int(channel)))
-        else:
-            entity = await client.get_entity(channel)
+        for i in range(0, total_messages, RESCRAPE_ID_BATCH):
+            batch_ids = message_ids[i:i + RESCRAPE_ID_BATCH]
+            try:
+                messages = await client.get_messages(entity, ids=batch_ids)
+            except RPCError as e:
+                print(f"\nError fetching messages {batch_ids[0]}-{batch_ids[-1]}: {e}")
+                mark_done(len(batch_ids))
+                continue
 
-        total_messages = 0
-        processed_messages = 0
+            for message_id, message in zip(batch_ids, messages):
+                if message is None or not message.media:
+                    # Deleted messages and removed media will never download
+                    updates.append((None, 'missing', message_id))
+                    mark_done()
+                else:
+                    pending.add(asyncio.ensure_future(rescrape(message)))
 
-        async for message in client.iter_messages(entity, offset_id=offset_id, reverse=True):
-            total_messages += 1
+            # Fetch the next id batch while this one downloads, but keep at most
+            # about one batch of messages in memory
+            while len(pending) > RESCRAPE_ID_BATCH:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if len(updates) >= write_batch_size:
+                flush_updates()
 
-        if total_messages == 0:
-            print(f"No messages found in channel {channel}.")
-            return
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        for task in pending:
+            task.cancel()
+        flush_updates()
+        conn.close()
+    print()
 
-        last_message_id = None
-        processed_messages = 0
+async def rescrape_all_media():
+    """Download missing media for every saved channel"""
+    if not state['channels']:
+        print("No channels added. Please add channels first.")
+        return
 
-        async for message in client.iter_messages(entity, offset_id=offset_id, reverse=True):
-            try:
-                sender = await message.get_sender()
-                save_message_to_db(channel, message, sender)
-
-                if state['scrape_media'] and message.media:
-                    media_path = await download_media(channel, message)
-                    if media_path:
-                        conn = sqlite3.connect(os.path.join(channel, f'{channel}.db'))
-                        c = conn.cursor()
-                        c.execute('''UPDATE messages SET media_path = ? WHERE message_id = ?''', (media_path, message.id))
-                        conn.commit()
-                        conn.close()
-                
-                last_message_id = message.id
-                processed_messages += 1
+    for channel in list(state['channels']):
+        print(f"\nChecking missing media for channel {channel}")
+        await rescrape_media(channel)
+    if media_store:
+        media_store.report()
+
+async def estimate_remaining_messages(entity, offset_id):
+    """Estimate how many messages are newer than offset_id with a single history request"""
+    latest = await client.get_messages(entity, limit=1)
+    if not latest or latest[0].id <= offset_id:
+        return 0
+
+    # The history response reports the channel's total message count; when
+    # resuming, the id span since the last scraped message is a tighter bound
+    total = getattr(latest, 'total', None) or latest[0].id
+    if offset_id:
+        total = min(total, latest[0].id - offset_id)
+    return max(total, 1)
+
+class PipelineStats:
+    """Per-stage throughput and peak queue depth for one channel's ingestion pipeline"""
+
+    STAGES = ('fetch', 'senders', 'write')
+
+    def __init__(self, channel, queues):
+        self.channel = channel
+        self.queues = queues
+        self.items = {stage: 0 for stage in self.STAGES}
+        self.busy = {stage: 0.0 for stage in self.STAGES}
+        self.max_depth = {name: 0 for name in queues}
+        self.started = time.monotonic()
+
+    def record(self, stage, items, seconds):
+        self.items[stage] += items
+        self.busy[stage] += seconds
+
+    def sample_queues(self):
+        for name, queue in self.queues.items():
+            self.max_depth[name] = max(self.max_depth[name], queue.qsize())
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        print(f"Pipeline stats for channel {self.channel} ({elapsed:.1f}s):")
+        for stage in self.STAGES:
+            rate = self.items[stage] / self.busy[stage] if self.busy[stage] else 0
+            print(f"  {stage:<8} {self.items[stage]:>8} msgs  busy {self.busy[stage]:>7.1f}s  {rate:>9.1f} msg/s")
+        depths = ', '.join(f"{name} {depth}/{self.queues[name].maxsize}" for name, depth in self.max_depth.items())
+        print(f"  Peak queue depth: {depths}")
+        print(f"  Bottleneck: {max(self.STAGES, key=lambda stage: self.busy[stage])}")
+
+async def iter_message_pages(entity, offset_id, page_size=100):
+    """Stream a channel's history oldest-first, grouped into pages of messages"""
+    page = []
+    async for message in client.iter_messages(entity, offset_id=offset_id, reverse=True):
+        page.append(message)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+async def scrape_channel(channel, offset_id, show_progress=True, entity=None):
+    """Scrape new messages from a channel and return a summary of the run"""
+    result = {'channel': channel, 'status': 'ok', 'messages': 0, 'error': None}
+    try:
+        if entity is None:
+            if channel.startswith('-'):
+                entity = await client.get_entity(PeerChannel(int(channel)))
+            else:
+                entity = await client.get_entity(channel)
 
-                progress = (processed_messages / total_messages) * 100
-                sys.stdout.write(f"\rScraping channel: {channel} - Progress: {progress:.2f}%")
-                sys.stdout.flush()
+        # state.json is only flushed periodically, so the database checkpoint may be ahead of it
+        offset_id = max(offset_id or 0, read_checkpoint(channel))
+        total_messages = await estimate_remaining_messages(entity, offset_id)
 
-                state['channels'][channel] = last_message_id
-                save_state(state)
-            except Exception as e:
-                print(f"Error processing message {message.id}: {e}")
-        print()
+        if total_messages == 0:
+            print(f"No messages found in channel {channel}.")
+            result['status'] = 'up to date'
+            return result
+
+        processed_messages = 0
+        writer = MessageWriter(channel, media_pool=get_media_pool() if state.get('scrape_media', True) else None)
+
+        # Stages are linked by bounded queues: history keeps streaming while earlier
+        # pages are persisted, and a slow stage blocks the fetcher instead of
+        # letting pages pile up in memory
+        queue_size = max(1, int(get_setting('limits', 'pipeline_queue_pages')))
+        pages = asyncio.Queue(maxsize=queue_size)
+        resolved = asyncio.Queue(maxsize=queue_size)
+        stats = PipelineStats(channel, {'pages': pages, 'resolved': resolved})
+
+        async def fetch_stage():
+            started = time.monotonic()
+            async for page in iter_message_pages(entity, offset_id):
+                stats.record('fetch', len(page), time.monotonic() - started)
+                await pages.put(page)
+                stats.sample_queues()
+                started = time.monotonic()
+            await pages.put(None)
+
+        async def sender_stage():
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                started = time.monotonic()
+                senders = await sender_cache.resolve(page)
+                stats.record('senders', len(page), time.monotonic() - started)
+                await resolved.put(list(zip(page, senders)))
+            await resolved.put(None)
+
+        async def write_stage():
+            nonlocal processed_messages
+            while True:
+                try:
+                    items = await asyncio.wait_for(resolved.get(), writer.flush_interval)
+                except asyncio.TimeoutError:
+                    # Commit what is buffered even while fetching stalls, e.g. during a FloodWait
+                    committed_id = writer.flush()
+                    if committed_id:
+                        record_progress(channel, committed_id)
+                    continue
+                if items is None:
+                    break
+                started = time.monotonic()
+                for message, sender in items:
+                    try:
+                        # Progress is only recorded once the batch holding the message is committed;
+                        # media is handed to the background pool once its row is committed
+                        committed_id = writer.add(message, sender)
+                        if committed_id:
+                            record_progress(channel, committed_id)
+
+                        processed_messages += 1
+
+                        if show_progress:
+                            # The total is an estimate (deleted messages leave gaps in the id span)
+                            progress = min(processed_messages / total_messages, 1) * 100
+                            sys.stdout.write(f"\rScraping channel: {channel} - Progress: {progress:.2f}%")
+                            sys.stdout.flush()
+                    except Exception as e:
+                        print(f"Error processing message {message.id}: {e}")
+                stats.record('write', len(items), time.monotonic() - started)
+
+        tasks = [asyncio.ensure_future(stage()) for stage in (fetch_stage, sender_stage, write_stage)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            committed_id = writer.close()
+            if committed_id:
+                record_progress(channel, committed_id, force=True)
+            result['messages'] = processed_messages
+
+        if show_progress:
+            if processed_messages:
+                sys.stdout.write(f"\rScraping channel: {channel} - Progress: 100.00%")
+            print()
+            print(f"Sender cache hit rate: {sender_cache.hit_rate():.1f}% "
+                  f"({sender_cache.page_fills} from history pages, {sender_cache.fetched} fetched)")
+        else:
+            print(f"Scraped {processed_messages} message(s) from channel {channel}")
+        if processed_messages:
+            stats.report()
     except ValueError as e:
         print(f"Error with channel {channel}: {e}")
+        result.update(status='failed', error=str(e))
     except Exception as e:
         print(f"Error scraping channel {channel}: {e}")
+        result.update(status='failed', error=str(e))
+    return result
+
+async def scrape_channels_concurrently(channels):
+    """Scrape channels with a bounded number in flight on the shared client
+
+    Each channel runs in its own task so a failure in one never stops the
+    others; per-channel progress bars are only shown when channels run one
+    at a time, since concurrent ones would overwrite each other.
+    """
+    total_channels = len(channels)
+    limit = max(1, min(int(get_setting('limits', 'max_concurrent_channels')), total_channels))
+    semaphore = asyncio.Semaphore(limit)
+    completed = 0
+
+    async def run(index, channel_id):
+        nonlocal completed
+        async with semaphore:
+            try:
+                entity = await get_entity_info(channel_id)
+                if entity:
+                    print(f"\n[{index}/{total_channels}] Scraping: {entity.title}")
+                    if limit == 1:
+                        print("-" * 50)
+                    result = await scrape_channel(channel_id, state['channels'].get(channel_id, 0),
+                                                  show_progress=(limit == 1), entity=entity)
+                    result['title'] = entity.title
+                else:
+                    print(f"\n[{index}/{total_channels}] Skipping invalid channel: {channel_id}")
+                    result = {'channel': channel_id, 'status': 'skipped', 'messages': 0,
+                              'error': 'Could not resolve channel'}
+            except Exception as e:
+                print(f"Error scraping channel {channel_id}: {e}")
+                result = {'channel': channel_id, 'status': 'failed', 'messages': 0, 'error': str(e)}
+            completed += 1
+            print(f"Progress: {completed}/{total_channels} channels processed")
+            return result
+
+    return await asyncio.gather(*(run(index, channel_id) for index, channel_id in enumerate(channels, 1)))
+
+def print_scrape_summary(results):
+    """Print a per-channel summary of a multi-channel scrape"""
+    print("\nScrape Summary")
+    print("-" * 70)
+    print(f"{'Channel':<30} {'Status':<12} {'Messages':<10} Error")
+    print("-" * 70)
+    for result in results:
+        name = (result.get('title') or result['channel'])[:30]
+        print(f"{name:<30} {result['status']:<12} {result['messages']:<10} {result['error'] or ''}")
+    print("-" * 70)
+    failed = sum(1 for result in results if result['status'] in ('failed', 'skipped'))
+    print(f"Channels: {len(results)} | Failed: {failed} | Messages: {sum(r['messages'] for r in results)}")
+
+CONTINUOUS_MODES = ('live', 'poll')
+POLL_RATE_ALPHA = 0.3
+LIVE_MAX_RECONNECT_DELAY = 300
+
+class PollScheduler:
+    """Schedules each channel's next poll for when about poll_target_messages are expected, from an EWMA of its rate"""
+
+    def __init__(self, channels, min_interval=None, max_interval=None, target_messages=None):
+        self.min_interval = float(min_interval or get_setting('continuous', 'poll_min_interval'))
+        self.max_interval = max(self.min_interval, float(max_interval or get_setting('continuous', 'poll_max_interval')))
+        self.target_messages = float(target_messages or get_setting('continuous', 'poll_target_messages'))
+        self.heap = []
+        self.rates = {}
+        self.last_poll = {}
+        self.sync(channels)
+
+    def sync(self, channels):
+        """Schedule newly added channels right away and forget removed ones"""
+        channels = set(channels)
+        if any(channel not in channels for _, channel in self.heap):
+            self.heap = [entry for entry in self.heap if entry[1] in channels]
+            heapq.heapify(self.heap)
+        scheduled = {channel for _, channel in self.heap}
+        now = time.monotonic()
+        for channel in sorted(channels - scheduled):
+            heapq.heappush(self.heap, (now, channel))
+
+    def next_wait(self):
+        """Seconds until the next channel is due"""
+        if not self.heap:
+            return self.max_interval
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def pop_due(self):
+        """Remove and return every channel that is due now"""
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def record(self, channel, new_messages, failed=False):
+        """Fold a finished poll into the channel's rate and schedule its next poll"""
+        now = time.monotonic()
+        previous = self.last_poll.get(channel)
+        self.last_poll[channel] = now
+        if failed:
+            interval = self.max_interval
+        elif previous is None:
+            # The first poll only catches up on the backlog, which says nothing about the rate
+            interval = self.min_interval
+        else:
+            sample = new_messages / max(now - previous, 1e-6)
+            rate = self.rates.get(channel)
+            rate = sample if rate is None else POLL_RATE_ALPHA * sample + (1 - POLL_RATE_ALPHA) * rate
+            self.rates[channel] = rate
+            interval = self.target_messages / rate if rate > 0 else self.max_interval
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        heapq.heappush(self.heap, (now + interval, channel))
+        return interval
 
 async def continuous_scraping():
+    """Keep every tracked channel archived, from live updates or by polling (continuous.mode)"""
+    if get_setting('continuous', 'mode') == 'live':
+        return await live_scraping()
+
     global continuous_scraping_active
     continuous_scraping_active = True
 
     try:
+        scheduler = PollScheduler(state['channels'])
         while continuous_scraping_active:
-            for channel in state['channels']:
-                print(f"\nChecking for new messages in channel: {channel}")
-                await scrape_channel(channel, state['channels'][channel])
-                print(f"New messages or media scraped from channel: {channel}")
-            await asyncio.sleep(60)
+            scheduler.sync(state['channels'])
+            # Wake at least every min interval so newly added channels are picked up promptly
+            await asyncio.sleep(min(scheduler.next_wait(), scheduler.min_interval))
+            due = scheduler.pop_due()
+            if not due:
+                continue
+
+            print(f"\nChecking for new messages in {len(due)} channel(s)")
+            results = await scrape_channels_concurrently(due)
+            for result in results:
+                interval = scheduler.record(result['channel'], result['messages'], result['status'] == 'failed')
+                rate = scheduler.rates.get(result['channel'])
+                rate_text = f"~{rate * 60:.2f} msg/min" if rate is not None else "rate not known yet"
+                print(f"  {result['channel']}: {result['messages']} new ({result['status']}), "
+                      f"{rate_text}, next check in {interval:.0f}s")
+            # Media keeps downloading in the background between polls
+            if media_pool:
+                media_pool.report()
     except asyncio.CancelledError:
         print("Continuous scraping stopped.")
         continuous_scraping_active = False
+    finally:
+        if media_pool:
+            await media_pool.stop()
+
+async def live_scraping():
+    """Archive new messages as Telegram pushes them, with catch-up scrapes to fill any gaps"""
+    global continuous_scraping_active
+    continuous_scraping_active = True
+
+    pool = get_media_pool() if state.get('scrape_media', True) else None
+    peers = {}
+    writers = {}
+    for channel in state['channels']:
+        entity = await get_entity_info(channel)
+        if entity:
+            peers[get_peer_id(entity)] = channel
+            # Updates can be lost around a reconnect without notice, so only catch-up
+            # scrapes, which read the history itself, move the checkpoint forward
+            writers[channel] = MessageWriter(channel, media_pool=pool, track_checkpoint=False)
+    if not writers:
+        print("No channels could be resolved for live updates.")
+        return
+
+    async def on_new_message(event):
+        channel = peers.get(event.chat_id)
+        if channel is None:
+            return
+        try:
+            senders = await sender_cache.resolve([event.message])
+            writers[channel].add(event.message, senders[0])
+        except Exception as e:
+            print(f"Error processing message {event.message.id} from channel {channel}: {e}")
+
+    async def catch_up():
+        print(f"\nCatching up on {len(writers)} channel(s) from their checkpoints...")
+        try:
+            print_scrape_summary(await scrape_channels_concurrently(list(writers)))
+        except Exception as e:
+            print(f"Catch-up failed: {e}")
+
+    def flush_writers(force=False):
+        for writer in writers.values():
+            writer.close() if force else writer.flush()
+
+    client.add_event_handler(on_new_message, events.NewMessage(chats=list(peers)))
+    flush_interval = max(0.1, get_setting('storage', 'flush_interval_ms') / 1000)
+    catch_up_interval = max(flush_interval, float(get_setting('continuous', 'catch_up_interval')))
+    # Catch-up runs beside the flush loop so live messages keep being committed meanwhile
+    catch_up_task = asyncio.create_task(catch_up())
+    last_catch_up = time.monotonic()
+    catch_up_due = False
+    reconnect_delay = 1
+    next_reconnect = 0
+    print("\nListening for new messages (press Ctrl+C to stop)...")
+    try:
+        while continuous_scraping_active:
+            await asyncio.sleep(flush_interval)
+            flush_writers()
+            if not client.is_connected():
+                # Telethon gave up reconnecting on its own; keep retrying with backoff
+                if time.monotonic() >= next_reconnect:
+                    print("\nConnection lost, reconnecting...")
+                    try:
+                        await client.connect()
+                        reconnect_delay = 1
+                        catch_up_due = True
+                    except Exception as e:
+                        print(f"Reconnect failed: {e}; retrying in {reconnect_delay}s")
+                        next_reconnect = time.monotonic() + reconnect_delay
+                        reconnect_delay = min(reconnect_delay * 2, LIVE_MAX_RECONNECT_DELAY)
+                continue
+            if time.monotonic() - last_catch_up >= catch_up_interval:
+                catch_up_due = True
+            if catch_up_due and catch_up_task.done():
+                catch_up_task = asyncio.create_task(catch_up())
+                last_catch_up = time.monotonic()
+                catch_up_due = False
+    except asyncio.CancelledError:
+        print("Live scraping stopped.")
+        continuous_scraping_active = False
+    finally:
+        catch_up_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await catch_up_task
+        client.remove_event_handler(on_new_message)
+        flush_writers(force=True)
+        if media_pool:
+            await media_pool.stop()
 
 async def export_data():
     if not state['channels']:
         print("No channels to export. Please add and scrape channels first.")
         return
-        
-    print("\nExporting data for all channels...")
-    for channel in state['channels']:
+
+    formats = [name for name in get_setting('export', 'formats') if name in EXPORT_FORMATS]
+    if 'parquet' in formats and pq is None:
+        print(f"Skipping Parquet export: {PYARROW_MISSING}")
+        formats.remove('parquet')
+    if not formats:
+        print("No export formats selected. Choose them under Settings > Export Settings.")
+        return
+
+    channels, filters = list(state['channels']), {}
+    if input("Choose channels, columns or filters for this export? [y/N]: ").strip().lower() == 'y':
         try:
-            print(f"\nExporting channel {channel}...")
-            export_to_csv(channel)
-            export_to_json(channel)
-            print(f"Successfully exported channel {channel} to CSV and JSON")
-        except Exception as e:
-            print(f"Error exporting channel {channel}: {e}")
+            channels, filters = prompt_export_filters()
+        except ValueError as e:
+            print(f"Invalid filter: {e}")
+            return
+    if filters:
+        if 'parquet' in formats:
+            print("Skipping Parquet export: filters apply to CSV and JSON only.")
+            formats.remove('parquet')
+        if not formats:
+            return
+        full = False
+    else:
+        full = input("Re-export everything instead of only new messages? [y/N]: ").strip().lower() == 'y'
+    jobs = [(channel, name) for channel in channels for name in formats]
+    if not jobs:
+        print("No channels selected.")
+        return
+    workers = int(get_setting('limits', 'export_workers')) or os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+    print(f"\nExporting {len(channels)} channel(s) to {', '.join(name.upper() for name in formats)} "
+          f"with {workers} worker process(es)...")
+
+    # Encoding is CPU-bound, so each channel/format pair runs in its own process
+    # while the event loop only collects results
+    loop = asyncio.get_event_loop()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        async def run_job(channel, name):
+            try:
+                return await loop.run_in_executor(executor, run_export_task, channel, name, full, filters)
+            except Exception as e:
+                # The worker process itself failed, e.g. it was killed
+                return {'channel': channel, 'format': name, 'status': 'failed',
+                        'error': str(e) or type(e).__name__, 'output': '', 'seconds': 0.0}
 
-def export_to_csv(channel):
-    db_file = os.path.join(os.getcwd(), channel, f'{channel}.db')
-    csv_file = os.path.join(os.getcwd(), channel, f'{channel}.csv')
-    
-    if not os.path.exists(db_file):
+        for done, job in enumerate(asyncio.as_completed([run_job(channel, name) for channel, name in jobs]), 1):
+            result = await job
+            results.append(result)
+            print(result['output'], end='')
+            status = 'done' if result['status'] == 'ok' else f"failed: {result['error']}"
+            print(f"[{done}/{len(jobs)}] {result['channel']} {result['format'].upper()} {status} "
+                  f"({result['seconds']:.1f}s)")
+
+    print_export_summary(results)
+
+def prompt_export_filters():
+    """Ask which channels to export and which columns and messages to include
+
+    Returns the channels and the row/column filters; empty filters mean
+    a normal incremental export of the chosen channels.
+    """
+    channels = list(state['channels'])
+    selected = [c.strip() for c in input("Channels, comma separated (blank for all): ").split(',') if c.strip()]
+    if selected:
+        unknown = [channel for channel in selected if channel not in state['channels']]
+        if unknown:
+            raise ValueError(f"not a saved channel: {', '.join(unknown)}")
+        channels = selected
+
+    filters = {}
+    columns = [c.strip() for c in input(f"Columns, comma separated ({', '.join(MESSAGE_COLUMNS)}; blank for all): ").split(',') if c.strip()]
+    if columns:
+        filters['columns'] = columns
+    for key, prompt in (('date_from', "From date YYYY-MM-DD (blank for any): "),
+                        ('date_to', "To date YYYY-MM-DD (blank for any): ")):
+        value = input(prompt).strip()
+        if value:
+            datetime.strptime(value, '%Y-%m-%d')
+            filters[key] = value
+    sender_id = input("Sender ID (blank for any): ").strip()
+    if sender_id:
+        filters['sender_id'] = int(sender_id)
+    media_type = input(f"Media type ({'/'.join(MEDIA_TYPE_ALIASES)}/none, blank for any): ").strip().lower()
+    if media_type:
+        filters['media_type'] = media_type
+    text = input("Containing text, search syntax (blank for any): ").strip()
+    if text:
+        filters['text'] = text
+    validate_export_filters(filters)
+    return channels, filters
+
+def run_export_task(channel, name, full, filters=None):
+    """Run one channel/format export in a worker process and report the outcome
+
+    Output is captured and handed back so the parent can print each
+    task's messages together instead of interleaved with other workers.
+    """
+    output = io.StringIO()
+    result = {'channel': channel, 'format': name, 'status': 'ok', 'error': None}
+    start = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(output):
+            EXPORT_FORMATS[name](channel, full, filters)
+    except Exception as e:
+        result.update(status='failed', error=str(e))
+    result['output'] = output.getvalue()
+    result['seconds'] = time.monotonic() - start
+    return result
+
+def print_export_summary(results):
+    """Print a per-channel summary of an export run"""
+    print("\nExport Summary")
+    print("-" * 70)
+    print(f"{'Channel':<30} {'Format':<10} {'Status':<10} Error")
+    print("-" * 70)
+    for result in sorted(results, key=lambda r: (r['channel'], r['format'])):
+        print(f"{result['channel'][:30]:<30} {result['format'].upper():<10} {result['status']:<10} {result['error'] or ''}")
+    print("-" * 70)
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    print(f"Exports: {len(results)} | Failed: {failed} | Time: {sum(r['seconds'] for r in results):.1f}s of work")
+
+JSON_STYLES = ('indent', 'compact', 'lines')
+
+def require_channel_db(channel):
+    if not os.path.exists(channel_db_path(channel)):
         raise FileNotFoundError(f"Database file not found for channel {channel}. Please scrape the channel first.")
-        
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute('SELECT * FROM messages')
-    rows = c.fetchall()
-    
-    if not rows:
-        print(f"No messages found in channel {channel}")
+
+def messages_after(conn, channel, last_message_id):
+    """Cursor over a channel's messages past last_message_id, in message_id order, that are ready to export"""
+    scope, scope_params = channel_scope(channel)
+    # Live mode stores new messages above the checkpoint before a catch-up fills the ids below them,
+    # and exported ids are never revisited, so only export up to the checkpoint
+    row = conn.execute('SELECT last_message_id FROM checkpoints WHERE channel = ?', (channel,)).fetchone()
+    end_id = max(row[0] if row else 0, int(state['channels'].get(channel) or 0)) + 1
+    condition, params = f'{scope} AND message_id > ?', scope_params + (last_message_id,)
+    if state.get('scrape_media', True):
+        # Incremental exports never rewrite a row, so stop before the first one still waiting for its media_path
+        pending_id = conn.execute(f'''SELECT MIN(message_id) FROM messages WHERE {condition} AND media_path IS NULL
+                                      AND media_type IN ('MessageMediaPhoto', 'MessageMediaDocument')
+                                      AND media_status = 'pending' ''', params).fetchone()[0]
+        if pending_id is not None and pending_id < end_id:
+            print(f"Holding back messages from {pending_id} on in channel {channel} until their media is downloaded "
+                  f"(use Download Missing Media for any left pending)")
+            end_id = pending_id
+    return conn.execute(f'''SELECT {", ".join(MESSAGE_COLUMNS)} FROM messages
+                           WHERE {condition} AND message_id < ? ORDER BY message_id''', params + (end_id,))
+
+def read_export_watermark(conn, channel, export):
+    """Return (last_message_id, byte_offset, rows, fingerprint) committed by an export, or (0, None, 0, None) if it never ran"""
+    row = conn.execute('''SELECT last_message_id, byte_offset, rows, fingerprint FROM export_watermarks
+                          WHERE channel = ? AND export = ?''', (channel, export)).fetchone()
+    return row or (0, None, 0, None)
+
+def write_export_watermark(conn, channel, export, last_message_id, byte_offset, rows, fingerprint=None):
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO export_watermarks
+                        (channel, export, last_message_id, byte_offset, rows, fingerprint, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                     (channel, export, last_message_id, byte_offset, rows, fingerprint))
+
+EXPORT_FINGERPRINT_BYTES = 4096
+
+def export_fingerprint(tail):
+    """Hash of the last bytes written before a watermark's offset"""
+    return hashlib.sha256(tail[-EXPORT_FINGERPRINT_BYTES:]).hexdigest()
+
+def read_export_tail(path, offset):
+    start = max(0, offset - EXPORT_FINGERPRINT_BYTES)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(offset - start)
+
+class CsvExport:
+    name = 'csv'
+    extension = 'csv'
+
+    def header(self, columns):
+        return self.encode(columns, [columns], True)
+
+    def encode(self, columns, rows, first):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+
+    def footer(self):
+        return ''
+
+class JsonExport:
+    """JSON output written one chunk at a time in the indent, compact or lines (JSON Lines) style"""
+
+    def __init__(self, style='indent'):
+        if style not in JSON_STYLES:
+            raise ValueError(f"Unknown JSON style {style!r}, expected one of {', '.join(JSON_STYLES)}")
+        self.style = style
+        self.name, self.extension = {
+            'indent': ('json', 'json'),
+            'compact': ('json-compact', 'compact.json'),
+            'lines': ('jsonl', 'jsonl'),
+        }[style]
+
+    def header(self, columns):
+        return '' if self.style == 'lines' else '['
+
+    def encode(self, columns, rows, first):
+        if self.style == 'indent':
+            items = (json.dumps(dict(zip(columns, row)), ensure_ascii=False, indent=4).replace('\n', '\n    ')
+                     for row in rows)
+            return ('\n    ' if first else ',\n    ') + ',\n    '.join(items)
+        items = (json.dumps(dict(zip(columns, row)), ensure_ascii=False, separators=(',', ':')) for row in rows)
+        if self.style == 'lines':
+            return '\n'.join(items) + '\n'
+        return ('' if first else ',') + ','.join(items)
+
+    def footer(self):
+        return {'indent': '\n]', 'compact': ']', 'lines': ''}[self.style]
+
+def export_messages(channel, export_format, full=False, filters=None):
+    """Append a channel's messages past the export's watermark to its output file"""
+    if filters:
+        return export_filtered_messages(channel, export_format, filters)
+    if get_setting('export', 'compression') != 'none' or rotation_limits() != (0, 0):
+        return export_message_parts(channel, export_format, full)
+
+    out_file = os.path.join(os.getcwd(), channel, f'{channel}.{export_format.extension}')
+    chunk_rows = max(1, int(get_setting('export', 'chunk_rows')))
+
+    require_channel_db(channel)
+
+    conn = open_channel_db(channel)
+    try:
+        last_message_id, offset, rows_done, fingerprint = read_export_watermark(conn, channel, export_format.name)
+        tail = b''
+        if not full and offset is not None and os.path.exists(out_file) and os.path.getsize(out_file) >= offset:
+            tail = read_export_tail(out_file, offset)
+        # Resume only a file that still holds, up to the offset, what this watermark recorded writing;
+        # any other export of it (e.g. from the other storage layout) starts over
+        if not tail or export_fingerprint(tail) != fingerprint:
+            last_message_id, offset, rows_done = 0, None, 0
+
+        cursor = messages_after(conn, channel, last_message_id)
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows and not rows_done:
+            print(f"No messages found in channel {channel}")
+            return
+
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        new_rows = 0
+        try:
+            with open(out_file, 'wb' if offset is None else 'r+b') as raw:
+                if offset is None:
+                    tail = export_format.header(MESSAGE_COLUMNS).encode('utf-8')
+                    raw.write(tail)
+                else:
+                    raw.truncate(offset)
+                    raw.seek(offset)
+                while rows:
+                    data = export_format.encode(MESSAGE_COLUMNS, rows, rows_done == 0).encode('utf-8')
+                    raw.write(data)
+                    raw.flush()
+                    tail = (tail + data[-EXPORT_FINGERPRINT_BYTES:])[-EXPORT_FINGERPRINT_BYTES:]
+                    rows_done += len(rows)
+                    new_rows += len(rows)
+                    write_export_watermark(conn, channel, export_format.name, rows[-1][0], raw.tell(), rows_done,
+                                           export_fingerprint(tail))
+                    rows = cursor.fetchmany(chunk_rows)
+                raw.write(export_format.footer().encode('utf-8'))
+        except OSError as e:
+            raise Exception(f"Error writing {export_format.name.upper()} file: {e}")
+        print(f"{export_format.name.upper()} file saved: {out_file} ({new_rows} new, {rows_done} total)")
+    finally:
         conn.close()
-        return
-        
+
+EXPORT_COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+ZSTD_MISSING = "zstd compression needs the optional zstandard package (pip install zstandard)"
+
+def rotation_limits():
+    """(bytes, rows) at which export parts are rotated, 0 meaning no limit"""
+    return (int(float(get_setting('export', 'rotate_mb')) * 1024 * 1024),
+            int(get_setting('export', 'rotate_rows')))
+
+def compress_chunk(data, compression):
+    """Compress data as a self-contained gzip member or zstd frame, so parts can be appended to and truncated"""
+    if compression == 'gzip':
+        # Level 6, the gzip tool's default, is far faster than 9 for a few percent in size
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'zstd':
+        # One frame per chunk: read parts with zstd -d or stream_reader(read_across_frames=True),
+        # as ZstdDecompressor().decompress() stops after the first frame
+        return zstd.ZstdCompressor().compress(data)
+    return data
+
+def save_manifest(manifest_file, manifest):
+    with open(f'{manifest_file}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+def export_message_parts(channel, export_format, full=False):
+    """Export a channel's messages into compressed and/or rotated part files listed in a manifest"""
+    require_channel_db(channel)
+
+    compression = get_setting('export', 'compression')
+    if compression not in EXPORT_COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(EXPORT_COMPRESSIONS)}")
+    if compression == 'zstd' and zstd is None:
+        print(f"{ZSTD_MISSING}; using gzip instead")
+        compression = 'gzip'
+    rotate_bytes, rotate_rows = rotation_limits()
+    chunk_rows = max(1, int(get_setting('export', 'chunk_rows')))
+    date_index = MESSAGE_COLUMNS.index('date')
+
+    channel_dir = os.path.join(os.getcwd(), channel)
+    manifest_file = os.path.join(channel_dir, f'{channel}.{export_format.extension}.manifest.json')
+    manifest = None
+    if not full and os.path.exists(manifest_file):
+        with open(manifest_file, encoding='utf-8') as f:
+            manifest = json.load(f)
+        parts = manifest.get('parts', [])
+        if manifest.get('compression') != compression:
+            print(f"Compression changed from {manifest.get('compression')} to {compression}; exporting again from the start")
+            manifest = None
+        elif any(not os.path.exists(os.path.join(channel_dir, part['file'])) for part in parts) or \
+                (parts and os.path.getsize(os.path.join(channel_dir, parts[-1]['file'])) < parts[-1]['bytes']):
+            print(f"Export parts listed in {manifest_file} are missing or cut short; exporting again from the start")
+            manifest = None
+    if manifest is None:
+        if os.path.exists(manifest_file):
+            with open(manifest_file, encoding='utf-8') as f:
+                for part in json.load(f).get('parts', []):
+                    if os.path.exists(os.path.join(channel_dir, part['file'])):
+                        os.remove(os.path.join(channel_dir, part['file']))
+        manifest = {'channel': channel, 'format': export_format.name, 'compression': compression,
+                    'rows': 0, 'last_message_id': 0, 'parts': []}
+
+    conn = open_channel_db(channel)
     try:
-        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([description[0] for description in c.description])
-            writer.writerows(rows)
-        print(f"CSV file saved: {csv_file}")
-    except Exception as e:
-        raise Exception(f"Error writing CSV file: {e}")
+        cursor = messages_after(conn, channel, manifest['last_message_id'])
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            if manifest['rows']:
+                print(f"{export_format.name.upper()} parts for channel {channel} are up to date ({manifest['rows']} rows)")
+            else:
+                print(f"No messages found in channel {channel}")
+            return
+
+        os.makedirs(channel_dir, exist_ok=True)
+        new_rows = 0
+        raw = None
+        try:
+            part = manifest['parts'][-1] if manifest['parts'] and not manifest['parts'][-1]['complete'] else None
+            if part:
+                raw = open(os.path.join(channel_dir, part['file']), 'r+b')
+                raw.truncate(part['bytes'])
+                raw.seek(part['bytes'])
+
+            while rows:
+                if part and ((rotate_bytes and part['bytes'] >= rotate_bytes) or (rotate_rows and part['rows'] >= rotate_rows)):
+                    raw.write(compress_chunk(export_format.footer().encode('utf-8'), compression))
+                    raw.close()
+                    part['bytes'] = os.path.getsize(os.path.join(channel_dir, part['file']))
+                    part['complete'] = True
+                    part = None
+                if part is None:
+                    part = {'file': f'{channel}.part-{len(manifest["parts"]) + 1:05d}.{export_format.extension}{EXPORT_COMPRESSIONS[compression]}',
+                            'rows': 0, 'bytes': 0, 'first_message_id': None, 'last_message_id': None,
+                            'first_date': None, 'last_date': None, 'complete': False}
+                    manifest['parts'].append(part)
+                    raw = open(os.path.join(channel_dir, part['file']), 'wb')
+                    raw.write(compress_chunk(export_format.header(MESSAGE_COLUMNS).encode('utf-8'), compression))
+
+                batch = rows[:rotate_rows - part['rows']] if rotate_rows else rows
+                rows = rows[len(batch):]
+                raw.write(compress_chunk(export_format.encode(MESSAGE_COLUMNS, batch, part['rows'] == 0).encode('utf-8'), compression))
+                raw.flush()
+
+                part['rows'] += len(batch)
+                part['bytes'] = raw.tell()
+                part['first_message_id'] = part['first_message_id'] or batch[0][0]
+                part['last_message_id'] = batch[-1][0]
+                dates = [row[date_index] for row in batch if row[date_index]]
+                if dates:
+                    part['first_date'] = min(dates + [part['first_date']] if part['first_date'] else dates)
+                    part['last_date'] = max(dates + [part['last_date']] if part['last_date'] else dates)
+                manifest['rows'] += len(batch)
+                manifest['last_message_id'] = batch[-1][0]
+                save_manifest(manifest_file, manifest)
+                new_rows += len(batch)
+                if not rows:
+                    rows = cursor.fetchmany(chunk_rows)
+
+            raw.write(compress_chunk(export_format.footer().encode('utf-8'), compression))
+        except OSError as e:
+            raise Exception(f"Error writing {export_format.name.upper()} part file: {e}")
+        finally:
+            if raw:
+                raw.close()
+        print(f"{export_format.name.upper()} parts saved: {manifest_file} "
+              f"({new_rows} new, {manifest['rows']} total in {len(manifest['parts'])} part(s))")
     finally:
         conn.close()
 
-def export_to_json(channel):
-    db_file = os.path.join(os.getcwd(), channel, f'{channel}.db')
-    json_file = os.path.join(os.getcwd(), channel, f'{channel}.json')
-    
-    if not os.path.exists(db_file):
-        raise FileNotFoundError(f"Database file not found for channel {channel}. Please scrape the channel first.")
-        
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute('SELECT * FROM messages')
-    rows = c.fetchall()
-    
-    if not rows:
-        print(f"No messages found in channel {channel}")
+EXPORT_FILTER_KEYS = ('columns', 'date_from', 'date_to', 'sender_id', 'media_type', 'text')
+
+def validate_export_filters(filters):
+    """Reject unknown filter keys and columns before they reach SQL"""
+    unknown = [key for key in filters if key not in EXPORT_FILTER_KEYS]
+    if unknown:
+        raise ValueError(f"unknown filter {', '.join(unknown)}")
+    unknown = [column for column in filters.get('columns', ()) if column not in MESSAGE_COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown column {', '.join(unknown)}; choose from {', '.join(MESSAGE_COLUMNS)}")
+
+def export_filter_label(filters):
+    """File name tag describing a filtered export, e.g. 2024-01-01_to_end.sender-42"""
+    labels = []
+    if filters.get('date_from') or filters.get('date_to'):
+        labels.append(f"{filters.get('date_from') or 'start'}_to_{filters.get('date_to') or 'end'}")
+    if filters.get('sender_id') is not None:
+        labels.append(f"sender-{filters['sender_id']}")
+    if filters.get('media_type'):
+        labels.append(f"media-{filters['media_type']}")
+    if filters.get('columns') or filters.get('text'):
+        labels.append('q' + hashlib.sha1(json.dumps(filters, sort_keys=True).encode('utf-8')).hexdigest()[:8])
+    return '.'.join(labels)
+
+def compile_export_query(conn, channel, filters):
+    """Compile export filters into one parameterized query, returning (sql, params, columns)"""
+    validate_export_filters(filters)
+    columns = tuple(filters.get('columns') or MESSAGE_COLUMNS)
+    scope, params = channel_scope(channel)
+    filter_sql, filter_params = message_filter_sql(filters.get('date_from'), filters.get('date_to'),
+                                                   filters.get('media_type'), filters.get('sender_id'), prefix='')
+    sql = f'SELECT {", ".join(columns)} FROM messages WHERE {scope}{filter_sql}'
+    params += filter_params
+    text = filters.get('text')
+    if text and has_search_index(conn):
+        if storage_layout() == 'consolidated':
+            sql += ' AND (channel, message_id) IN (SELECT channel, message_id FROM messages_fts WHERE messages_fts MATCH ?)'
+        else:
+            sql += ' AND message_id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)'
+        params += (text,)
+    elif text:
+        sql += " AND message LIKE '%' || ? || '%'"
+        params += (text,)
+    return sql + ' ORDER BY date, message_id', params, columns
+
+def export_filtered_messages(channel, export_format, filters):
+    """Export a filtered, column-projected snapshot of a channel's messages to its own file"""
+    out_file = os.path.join(os.getcwd(), channel, f'{channel}.{export_filter_label(filters)}.{export_format.extension}')
+    chunk_rows = max(1, int(get_setting('export', 'chunk_rows')))
+
+    require_channel_db(channel)
+
+    conn = open_channel_db(channel)
+    try:
+        sql, params, columns = compile_export_query(conn, channel, filters)
+        cursor = conn.execute(sql, params)
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        exported = 0
+        try:
+            with open(f'{out_file}.tmp', 'wb') as raw:
+                raw.write(export_format.header(columns).encode('utf-8'))
+                rows = cursor.fetchmany(chunk_rows)
+                while rows:
+                    raw.write(export_format.encode(columns, rows, exported == 0).encode('utf-8'))
+                    exported += len(rows)
+                    rows = cursor.fetchmany(chunk_rows)
+                raw.write(export_format.footer().encode('utf-8'))
+            os.replace(f'{out_file}.tmp', out_file)
+        except OSError as e:
+            raise Exception(f"Error writing {export_format.name.upper()} file: {e}")
+        print(f"{export_format.name.upper()} file saved: {out_file} ({exported} matching messages)")
+    finally:
         conn.close()
-        return
-        
+
+def export_to_csv(channel, full=False, filters=None):
+    export_messages(channel, CsvExport(), full, filters)
+
+def export_to_json(channel, full=False, filters=None, style=None):
+    export_messages(channel, JsonExport(style or get_setting('export', 'json_style')), full, filters)
+
+PYARROW_MISSING = "Parquet export needs the optional pyarrow package. Install it with: pip install pyarrow"
+PARQUET_ROW_GROUP_PERIODS = {'year': 4, 'month': 7, 'day': 10}
+PARQUET_MAX_ROW_GROUP_ROWS = 100000
+
+def parquet_schemas():
+    """Arrow schemas for the messages and users tables
+
+    Names, media types and statuses repeat heavily and are stored
+    dictionary-encoded; timestamps are stored in UTC.
+    """
+    timestamp = pa.timestamp('s', tz='UTC')
+    label = pa.dictionary(pa.int32(), pa.string())
+    messages = pa.schema([
+        ('message_id', pa.int64()), ('date', timestamp), ('sender_id', pa.int64()),
+        ('first_name', label), ('last_name', label), ('username', label),
+        ('message', pa.string()), ('media_type', label), ('media_path', pa.string()),
+        ('reply_to', pa.int64()), ('media_status', label),
+    ])
+    users = pa.schema([
+        ('user_id', pa.int64()), ('username', pa.string()), ('first_name', label), ('last_name', label),
+        ('phone', pa.string()), ('is_bot', pa.bool_()), ('is_verified', pa.bool_()),
+        ('is_restricted', pa.bool_()), ('is_scam', pa.bool_()), ('is_fake', pa.bool_()),
+        ('date_joined', timestamp), ('status', label), ('updated_at', timestamp),
+    ])
+    return messages, users
+
+def parse_db_timestamp(value):
+    """Parse a stored timestamp; values without an offset were written in UTC"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def rows_to_table(rows, schema):
+    """Build an Arrow table from database rows in schema column order"""
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_timestamp(field.type):
+            values = [parse_db_timestamp(value) for value in values]
+        elif pa.types.is_boolean(field.type):
+            values = [None if value is None else bool(value) for value in values]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def parquet_writer(path, schema):
+    dictionary_columns = [field.name for field in schema if pa.types.is_dictionary(field.type)]
+    return pq.ParquetWriter(path, schema, use_dictionary=dictionary_columns, compression='snappy')
+
+def parquet_part_first_id(name):
+    """First message id covered by a part-<first>-<last>.parquet file name, or None for other files"""
+    parts = name[:-len('.parquet')].split('-') if name.endswith('.parquet') else []
+    if len(parts) != 3 or parts[0] != 'part' or not parts[1].isdigit():
+        return None
+    return int(parts[1])
+
+def export_to_parquet(channel, full=False, filters=None):
+    """Append a channel's new messages to its Parquet parts and rewrite its users table"""
+    if pq is None:
+        raise ImportError(PYARROW_MISSING)
+    if filters:
+        raise ValueError("Filtered exports are available for CSV and JSON only")
+
+    require_channel_db(channel)
+
+    messages_schema, users_schema = parquet_schemas()
+    parts_dir = os.path.join(os.getcwd(), channel, 'parquet', 'messages')
+    period = PARQUET_ROW_GROUP_PERIODS.get(get_setting('export', 'parquet_row_group_by'), PARQUET_ROW_GROUP_PERIODS['month'])
+    chunk_rows = max(1, int(get_setting('export', 'chunk_rows')))
+
+    conn = open_channel_db(channel)
     try:
-        data = [dict(zip([description[0] for description in c.description], row)) for row in rows]
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        print(f"JSON file saved: {json_file}")
-    except Exception as e:
-        raise Exception(f"Error writing JSON file: {e}")
+        last_message_id, _, rows_done, _ = read_export_watermark(conn, channel, 'parquet')
+        if full:
+            last_message_id, rows_done = 0, 0
+        os.makedirs(parts_dir, exist_ok=True)
+        for name in os.listdir(parts_dir):
+            first_id = parquet_part_first_id(name)
+            if first_id is None or first_id > last_message_id:
+                os.remove(os.path.join(parts_dir, name))
+
+        cursor = messages_after(conn, channel, last_message_id)
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            print(f"No new messages to export to Parquet for channel {channel}")
+        else:
+            first_id = rows[0][0]
+            new_rows = 0
+            group = []
+            tmp_file = os.path.join(parts_dir, 'part.parquet.tmp')
+            with parquet_writer(tmp_file, messages_schema) as writer:
+                while rows:
+                    for row in rows:
+                        if group and ((row[1] or '')[:period] != (group[-1][1] or '')[:period]
+                                      or len(group) >= PARQUET_MAX_ROW_GROUP_ROWS):
+                            writer.write_table(rows_to_table(group, messages_schema), row_group_size=len(group))
+                            group = []
+                        group.append(row)
+                    new_rows += len(rows)
+                    last_message_id = rows[-1][0]
+                    rows = cursor.fetchmany(chunk_rows)
+                if group:
+                    writer.write_table(rows_to_table(group, messages_schema), row_group_size=len(group))
+
+            part_file = os.path.join(parts_dir, f'part-{first_id:012d}-{last_message_id:012d}.parquet')
+            os.replace(tmp_file, part_file)
+            rows_done += new_rows
+            write_export_watermark(conn, channel, 'parquet', last_message_id, None, rows_done)
+            print(f"Parquet file saved: {part_file} ({new_rows} new, {rows_done} total)")
+    finally:
+        conn.close()
+
+    users_db = os.path.join(os.getcwd(), channel, f'{channel}_users.db')
+    if os.path.exists(users_db):
+        users_file = os.path.join(os.getcwd(), channel, 'parquet', 'users.parquet')
+        conn = open_users_db(users_db)
+        try:
+            cursor = conn.execute(f"SELECT {', '.join(users_schema.names)} FROM users ORDER BY user_id")
+            with parquet_writer(users_file + '.tmp', users_schema) as writer:
+                rows = cursor.fetchmany(chunk_rows)
+                while rows:
+                    writer.write_table(rows_to_table(rows, users_schema))
+                    rows = cursor.fetchmany(chunk_rows)
+            os.replace(users_file + '.tmp', users_file)
+            print(f"Parquet file saved: {users_file}")
+        finally:
+            conn.close()
+
+EXPORT_FORMATS = {
+    'csv': export_to_csv,
+    'json': export_to_json,
+    'parquet': export_to_parquet,
+}
+
+SEARCH_RESULT_LIMIT = 20
+SEARCH_ORDERS = ('relevance', 'date')
+MEDIA_TYPE_ALIASES = {
+    'photo': 'MessageMediaPhoto',
+    'document': 'MessageMediaDocument',
+    'webpage': 'MessageMediaWebPage',
+}
+
+def message_filter_sql(date_from=None, date_to=None, media_type=None, sender_id=None, prefix='m.'):
+    """SQL conditions and parameters restricting messages by date range (inclusive days), media type and sender
+
+    The conditions are plain comparisons on indexed columns, so they can
+    be answered from the messages indexes.
+    """
+    conditions, params = [], []
+    if date_from:
+        conditions.append(f'{prefix}date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append(f"{prefix}date < date(?, '+1 day')")
+        params.append(date_to)
+    if media_type == 'none':
+        conditions.append(f'{prefix}media_type IS NULL')
+    elif media_type:
+        conditions.append(f'{prefix}media_type = ?')
+        params.append(MEDIA_TYPE_ALIASES.get(media_type.lower(), media_type))
+    if sender_id is not None:
+        conditions.append(f'{prefix}sender_id = ?')
+        params.append(sender_id)
+    return ''.join(f' AND {condition}' for condition in conditions), tuple(params)
+
+def search_channel_db(conn, query, limit, channels=None, order='relevance', filters=('', ()), layout=None):
+    """Return a database's best matches for an FTS5 query as (rank, channel, message_id, date, snippet)
+
+    channels names the channel a per-channel database belongs to (one
+    entry) or restricts a consolidated archive to a subset.
+    """
+    filter_sql, filter_params = filters
+    if storage_layout(layout) == 'consolidated':
+        sql = '''SELECT messages_fts.rank, messages_fts.channel, messages_fts.message_id, m.date,
+                        snippet(messages_fts, 0, '[', ']', '...', 12)
+                 FROM messages_fts JOIN messages m
+                   ON m.channel = messages_fts.channel AND m.message_id = messages_fts.message_id
+                 WHERE messages_fts MATCH ?'''
+        params = (query,)
+        if channels is not None:
+            sql += f" AND messages_fts.channel IN ({', '.join('?' for _ in channels)})"
+            params += tuple(channels)
+    else:
+        sql = '''SELECT messages_fts.rank, ?, m.message_id, m.date,
+                        snippet(messages_fts, 0, '[', ']', '...', 12)
+                 FROM messages_fts JOIN messages m ON m.message_id = messages_fts.rowid
+                 WHERE messages_fts MATCH ?'''
+        params = (channels[0] if channels else None, query)
+    sql += filter_sql + (' ORDER BY m.date DESC' if order == 'date' else ' ORDER BY messages_fts.rank')
+    return conn.execute(sql + ' LIMIT ?', params + filter_params + (limit,)).fetchall()
+
+def search_database(channel, query, limit, order, filters, channels=None):
+    """Search one archive database from a worker thread, with its own connection"""
+    if not os.path.exists(channel_db_path(channel)):
+        return []
+    conn = open_channel_db(channel)
+    try:
+        if not has_search_index(conn):
+            return []
+        return search_channel_db(conn, query, limit, channels if channel is None else [channel], order, filters)
     finally:
         conn.close()
 
+async def search_messages(query, channels=None, limit=SEARCH_RESULT_LIMIT, order='relevance',
+                          date_from=None, date_to=None, media_type=None):
+    """Search archived message text (FTS5 syntax) in parallel and return the global top hits, best first"""
+    filters = message_filter_sql(date_from, date_to, media_type)
+    if storage_layout() == 'consolidated':
+        jobs = [(None, channels)]
+    else:
+        jobs = [(channel, None) for channel in (channels if channels is not None else state['channels'])]
+
+    # The heap's smallest entry is the weakest hit kept so far
+    def heap_key(hit):
+        return hit[3] if order == 'date' else -hit[0]
+
+    top = []
+    loop = asyncio.get_event_loop()
+    workers = max(1, int(get_setting('limits', 'search_workers')))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        tasks = [loop.run_in_executor(executor, search_database, channel, query, limit, order, filters, subset)
+                 for channel, subset in jobs]
+        try:
+            for task in asyncio.as_completed(tasks):
+                for hit in await task:
+                    entry = (heap_key(hit), hit)
+                    if len(top) < limit:
+                        heapq.heappush(top, entry)
+                    elif entry[0] > top[0][0]:
+                        heapq.heapreplace(top, entry)
+        finally:
+            for task in tasks:
+                task.cancel()
+    return [hit for key, hit in sorted(top, key=lambda entry: entry[0], reverse=True)]
+
+async def search_archive():
+    query = input("Enter search terms: ").strip()
+    if not query:
+        return
+    channel_filter = input("Channels (comma separated, blank for all): ").strip()
+    date_from = input("From date YYYY-MM-DD (blank for any): ").strip() or None
+    date_to = input("To date YYYY-MM-DD (blank for any): ").strip() or None
+    media_type = input(f"Media type ({'/'.join(MEDIA_TYPE_ALIASES)}/none, blank for any): ").strip().lower() or None
+    order = input(f"Order by {'/'.join(SEARCH_ORDERS)} [relevance]: ").strip().lower() or 'relevance'
+    if order not in SEARCH_ORDERS:
+        print("Invalid order.")
+        return
+    channels = [c.strip() for c in channel_filter.split(',') if c.strip()] or None
+
+    try:
+        start = time.monotonic()
+        hits = await search_messages(query, channels, order=order, date_from=date_from,
+                                     date_to=date_to, media_type=media_type)
+        elapsed = time.monotonic() - start
+    except sqlite3.OperationalError as e:
+        print(f"Invalid search query: {e}")
+        return
+
+    if not hits:
+        print("No matching messages found.")
+        return
+    print(f"\n{len(hits)} best match(es) in {elapsed * 1000:.0f} ms:")
+    for rank, channel, message_id, date, snippet in hits:
+        print(f"[{channel}] {date} (message {message_id}): {snippet}")
+
 async def view_channels():
     if not state['channels']:
         print("No channels to view.")
@@ -417,25 +2375,9 @@ async def get_channel_users(channel):
         
         # Setup database
         db_file = os.path.join(channel_dir, f'{channel}_users.db')
-        conn = sqlite3.connect(db_file)
+        conn = open_users_db(db_file)
         c = conn.cursor()
         
-        # Create users table with specified fields
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                    (user_id INTEGER PRIMARY KEY,
-                     username TEXT,
-                     first_name TEXT,
-                     last_name TEXT,
-                     phone TEXT,
-                     is_bot BOOLEAN,
-                     is_verified BOOLEAN,
-                     is_restricted BOOLEAN,
-                     is_scam BOOLEAN,
-                     is_fake BOOLEAN,
-                     date_joined TIMESTAMP,
-                     status TEXT,
-                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        
         total_users = 0
         new_users = 0
         updated_users = 0
@@ -649,6 +2591,8 @@ async def channel_management_menu():
         print("[C] Continuous Scraping")
         print("[E] Export Data")
         print("[U] Get User Details")
+        print("[D] Download Missing Media")
+        print("[F] Search Messages")
         print("[Q] Back to Main Menu")
         print("--------------------")
         print("List all saved channels")
@@ -676,6 +2620,10 @@ async def channel_management_menu():
             await export_data()
         elif choice == 'U':
             await get_all_users()
+        elif choice == 'D':
+            await rescrape_all_media()
+        elif choice == 'F':
+            await search_archive()
         else:
             print("Invalid choice. Please try again.")
 
@@ -861,25 +2809,9 @@ async def get_channel_users(channel):
         
         # Create or connect to SQLite database
         db_file = os.path.join(channel_dir, f'{channel}_users.db')
-        conn = sqlite3.connect(db_file)
+        conn = open_users_db(db_file)
         c = conn.cursor()
         
-        # Create users table with additional fields
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                    (user_id INTEGER PRIMARY KEY,
-                     username TEXT,
-                     first_name TEXT,
-                     last_name TEXT,
-                     phone TEXT,
-                     is_bot BOOLEAN,
-                     is_verified BOOLEAN,
-                     is_restricted BOOLEAN,
-                     is_scam BOOLEAN,
-                     is_fake BOOLEAN,
-                     date_joined TIMESTAMP,
-                     status TEXT,
-                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        
         print(f"\nFetching users from {entity.title}")
         print(f"Channel ID: {channel}")
         
@@ -1098,14 +3030,55 @@ DEFAULT_SETTINGS = {
     },
     'limits': {
         'max_channels_per_hour': 20,    # maximum channels to process per hour
-        'max_retries': 3               # maximum retries on error
+        'max_retries': 3,              # maximum retries on error
+        'max_concurrent_channels': 4,  # channels scraped at the same time
+        'pipeline_queue_pages': 4,     # history pages buffered between scrape stages
+        'media_workers': 4,            # concurrent background media downloads
+        'media_queue_size': 1000,      # queued downloads before new media is left pending
+        'large_file_threshold_mb': 20, # documents at least this big download in parallel ranges
+        'download_connections': 4,     # parallel ranges per large document
+        'search_workers': 8,           # archive databases searched at the same time
+        'export_workers': 0            # export processes; 0 uses one per CPU core
     },
     'paths': {
         'base_dir': os.getcwd(),       # base directory for saving data
-        'logs_dir': 'logs'             # directory for logs
+        'logs_dir': 'logs',            # directory for logs
+        'media_store': 'media_store',  # shared, deduplicated media files for all channels
+        'archive_db': 'archive.db'     # database for all channels in the consolidated layout
+    },
+    'storage': {
+        'write_batch_size': 500,       # messages per database transaction
+        'flush_interval_ms': 1000,     # maximum time a message waits in the write buffer
+        'checkpoint_interval': 10,     # seconds between state.json progress flushes
+        'dedupe_media': True,          # keep one copy of media forwarded into several channels
+        'journal_mode': 'WAL',         # lets readers run while the scraper writes
+        'synchronous': 'NORMAL',       # crash-safe under WAL without a sync per commit
+        'mmap_size_mb': 256,           # memory-mapped read window per database
+        'cache_size_mb': 64,           # page cache per connection
+        'layout': 'per_channel'        # per_channel or consolidated; change with Convert Storage Layout
+    },
+    'continuous': {
+        'mode': 'live',                # live (update events) or poll
+        'poll_min_interval': 10,       # seconds; the busiest channels are never polled more often
+        'poll_max_interval': 900,      # seconds; quiet channels are still polled at least this often
+        'poll_target_messages': 20,    # poll when about this many new messages are expected
+        'catch_up_interval': 300       # seconds; live mode rescans from the checkpoint this often to fill gaps
+    },
+    'export': {
+        'formats': ['csv', 'json'],    # any of csv, json and parquet (needs pyarrow)
+        'chunk_rows': 5000,            # rows read and written per export chunk
+        'json_style': 'indent',        # indent, compact or lines (JSON Lines)
+        'parquet_row_group_by': 'month', # year, month or day
+        'compression': 'none',         # none, gzip or zstd (needs zstandard)
+        'rotate_mb': 0,                # start a new part file at this size; 0 for no limit
+        'rotate_rows': 0               # start a new part file at this many rows; 0 for no limit
     }
 }
 
+def get_setting(section, key):
+    """Read a single setting, falling back to the default for keys missing from older state files"""
+    return state.get('settings', {}).get(section, {}).get(key, DEFAULT_SETTINGS[section][key])
+
 def load_settings():
     """Load settings from state file"""
     state = load_state()
@@ -1116,9 +3089,11 @@ def load_settings():
 
 def save_settings(settings):
     """Save settings to state file"""
-    state = load_state()
+    saved_state = load_state()
+    saved_state['settings'] = settings
+    save_state(saved_state)
+    # Keep the in-memory state used by the scraper in sync
     state['settings'] = settings
-    save_state(state)
 
 def clean_channel_name(name):
     """Clean channel name for directory naming"""
@@ -1166,25 +3141,9 @@ async def god_mode():
                 
                 # Setup database
                 db_file = os.path.join(channel_dir, 'users.db')
-                conn = sqlite3.connect(db_file)
+                conn = open_users_db(db_file)
                 c = conn.cursor()
                 
-                # Create users table
-                c.execute('''CREATE TABLE IF NOT EXISTS users
-                            (user_id INTEGER PRIMARY KEY,
-                             username TEXT,
-                             first_name TEXT,
-                             last_name TEXT,
-                             phone TEXT,
-                             is_bot BOOLEAN,
-                             is_verified BOOLEAN,
-                             is_restricted BOOLEAN,
-                             is_scam BOOLEAN,
-                             is_fake BOOLEAN,
-                             date_joined TIMESTAMP,
-                             status TEXT,
-                             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-                
                 # Get participants with batching
                 try:
                     participants = []
@@ -1314,6 +3273,11 @@ async def settings_menu():
         print("\nSettings")
         print("-" * 40)
         print("[D] Delay Settings")
+        print("[L] Limit Settings")
+        print("[T] Storage Settings")
+        print("[C] Convert Storage Layout")
+        print("[X] Export Settings")
+        print("[M] Continuous Mode")
         print("[P] Path Settings")
         print("[S] Show Current Settings")
         print("[R] Reset to Default")
@@ -1330,6 +3294,94 @@ async def settings_menu():
             settings['delays']['between_batches'] = float(input(f"Seconds between batches [{settings['delays']['between_batches']}]: ") or settings['delays']['between_batches'])
             settings['delays']['batch_size'] = int(input(f"Users per batch [{settings['delays']['batch_size']}]: ") or settings['delays']['batch_size'])
             save_settings(settings)
+        elif choice == 'L':
+            print("\nLimit Settings")
+            print("-" * 40)
+            limits = settings.setdefault('limits', dict(DEFAULT_SETTINGS['limits']))
+            current = limits.get('max_concurrent_channels', DEFAULT_SETTINGS['limits']['max_concurrent_channels'])
+            limits['max_concurrent_channels'] = int(input(f"Channels scraped concurrently [{current}]: ") or current)
+            current = limits.get('search_workers', DEFAULT_SETTINGS['limits']['search_workers'])
+            limits['search_workers'] = int(input(f"Archives searched concurrently [{current}]: ") or current)
+            current = limits.get('export_workers', DEFAULT_SETTINGS['limits']['export_workers'])
+            limits['export_workers'] = int(input(f"Export processes, 0 for one per CPU core [{current}]: ") or current)
+            save_settings(settings)
+        elif choice == 'T':
+            print("\nStorage Settings")
+            print("-" * 40)
+            storage = settings.setdefault('storage', {})
+            current = {key: storage.get(key, default) for key, default in DEFAULT_SETTINGS['storage'].items()}
+            journal_mode = (input(f"Journal mode {'/'.join(SQLITE_JOURNAL_MODES)} [{current['journal_mode']}]: ") or current['journal_mode']).upper()
+            synchronous = (input(f"Sync level {'/'.join(SQLITE_SYNC_LEVELS)} [{current['synchronous']}]: ") or current['synchronous']).upper()
+            if journal_mode not in SQLITE_JOURNAL_MODES or synchronous not in SQLITE_SYNC_LEVELS:
+                print("\nInvalid journal mode or sync level. Settings not changed.")
+                continue
+            storage['journal_mode'] = journal_mode
+            storage['synchronous'] = synchronous
+            storage['mmap_size_mb'] = int(input(f"Memory-mapped window in MB [{current['mmap_size_mb']}]: ") or current['mmap_size_mb'])
+            storage['cache_size_mb'] = int(input(f"Page cache in MB [{current['cache_size_mb']}]: ") or current['cache_size_mb'])
+            save_settings(settings)
+        elif choice == 'C':
+            print("\nConvert Storage Layout")
+            print("-" * 40)
+            print(f"Current layout: {storage_layout()}")
+            print("[1] per_channel  - one database per channel")
+            print("[2] consolidated - all channels in one archive database")
+            target = {'1': 'per_channel', '2': 'consolidated'}.get(input("\nConvert to (1-2): ").strip())
+            if not target:
+                print("\nInvalid choice.")
+                continue
+            confirm = input(f"Copy all channel data into the {target} layout? [y/N]: ")
+            if confirm.lower() == 'y':
+                convert_storage_layout(target)
+        elif choice == 'X':
+            print("\nExport Settings")
+            print("-" * 40)
+            export = settings.setdefault('export', {})
+            current = {key: export.get(key, default) for key, default in DEFAULT_SETTINGS['export'].items()}
+            json_style = (input(f"JSON style {'/'.join(JSON_STYLES)} [{current['json_style']}]: ") or current['json_style']).lower()
+            if json_style not in JSON_STYLES:
+                print("\nInvalid JSON style. Settings not changed.")
+                continue
+            export['json_style'] = json_style
+            formats = input(f"Formats, comma separated ({'/'.join(EXPORT_FORMATS)}) [{','.join(current['formats'])}]: ")
+            formats = [name.strip().lower() for name in formats.split(',') if name.strip()] or current['formats']
+            if any(name not in EXPORT_FORMATS for name in formats):
+                print("\nUnknown export format. Settings not changed.")
+                continue
+            if 'parquet' in formats and pq is None:
+                print(f"\nNote: {PYARROW_MISSING}")
+            export['formats'] = formats
+            compression = (input(f"Compression {'/'.join(EXPORT_COMPRESSIONS)} [{current['compression']}]: ") or current['compression']).lower()
+            if compression not in EXPORT_COMPRESSIONS:
+                print("\nUnknown compression. Settings not changed.")
+                continue
+            if compression == 'zstd' and zstd is None:
+                print(f"\nNote: {ZSTD_MISSING}; gzip will be used until it is installed")
+            export['compression'] = compression
+            export['rotate_mb'] = float(input(f"Start a new part file at this many MB, 0 for no limit [{current['rotate_mb']}]: ") or current['rotate_mb'])
+            export['rotate_rows'] = int(input(f"Start a new part file at this many rows, 0 for no limit [{current['rotate_rows']}]: ") or current['rotate_rows'])
+            export['chunk_rows'] = int(input(f"Rows per export chunk [{current['chunk_rows']}]: ") or current['chunk_rows'])
+            save_settings(settings)
+        elif choice == 'M':
+            print("\nContinuous Mode")
+            print("-" * 40)
+            print("live - archive messages as Telegram pushes them, catching up after reconnects")
+            print("poll - check each channel on a schedule adapted to how busy it is")
+            continuous = settings.setdefault('continuous', {})
+            current = continuous.get('mode', DEFAULT_SETTINGS['continuous']['mode'])
+            mode = (input(f"Mode {'/'.join(CONTINUOUS_MODES)} [{current}]: ") or current).lower()
+            if mode not in CONTINUOUS_MODES:
+                print("\nInvalid mode. Settings not changed.")
+                continue
+            continuous['mode'] = mode
+            current = {key: continuous.get(key, default) for key, default in DEFAULT_SETTINGS['continuous'].items()}
+            if mode == 'live':
+                continuous['catch_up_interval'] = float(input(f"Seconds between catch-up scrapes that fill gaps [{current['catch_up_interval']}]: ") or current['catch_up_interval'])
+            if mode == 'poll':
+                continuous['poll_min_interval'] = float(input(f"Minimum seconds between polls of a channel [{current['poll_min_interval']}]: ") or current['poll_min_interval'])
+                continuous['poll_max_interval'] = float(input(f"Maximum seconds between polls of a channel [{current['poll_max_interval']}]: ") or current['poll_max_interval'])
+                continuous['poll_target_messages'] = int(input(f"New messages expected per poll [{current['poll_target_messages']}]: ") or current['poll_target_messages'])
+            save_settings(settings)
         elif choice == 'P':
             print("\nPath Settings")
             print("-" * 40)
@@ -1348,9 +3400,22 @@ async def settings_menu():
             print("\nPaths:")
             for k, v in settings['paths'].items():
                 print(f"- {k}: {v}")
+            print("\nStorage:")
+            for k, default in DEFAULT_SETTINGS['storage'].items():
+                print(f"- {k}: {settings.get('storage', {}).get(k, default)}")
+            print("\nContinuous:")
+            for k, default in DEFAULT_SETTINGS['continuous'].items():
+                print(f"- {k}: {settings.get('continuous', {}).get(k, default)}")
+            print("\nExport:")
+            for k, default in DEFAULT_SETTINGS['export'].items():
+                print(f"- {k}: {settings.get('export', {}).get(k, default)}")
             input("\nPress Enter to continue...")
         elif choice == 'R':
-            save_settings(DEFAULT_SETTINGS)
+            defaults = copy.deepcopy(DEFAULT_SETTINGS)
+            # The layout says where the data already is; only Convert Storage Layout may change it
+            defaults['storage']['layout'] = storage_layout()
+            defaults['paths']['archive_db'] = get_setting('paths', 'archive_db')
+            save_settings(defaults)
             print("\nSettings reset to default.")
         else:
             print("\nInvalid choice. Please try again.")
@@ -1534,18 +3599,13 @@ async def scrape_all_channels():
     total_channels = len(state['channels'])
     print(f"\nPreparing to scrape {total_channels} channel(s)...")
     
-    for index, channel_id in enumerate(state['channels'].keys(), 1):
-        try:
-            entity = await get_entity_info(channel_id)
-            if entity:
-                print(f"\n[{index}/{total_channels}] Scraping: {entity.title}")
-                print("-" * 50)
-                await scrape_channel(channel_id, state['channels'][channel_id])
-            else:
-                print(f"\n[{index}/{total_channels}] Skipping invalid channel: {channel_id}")
-        except Exception as e:
-            print(f"Error scraping channel {channel_id}: {e}")
-        print(f"Progress: {index}/{total_channels} channels processed")
+    results = await scrape_channels_concurrently(list(state['channels'].keys()))
+    print_scrape_summary(results)
+
+    # Text is archived; let queued media finish before returning to the menu
+    if media_pool:
+        await media_pool.drain()
+        media_pool.report()
     
     print("\nScraping completed!")
 
@@ -1561,25 +3621,9 @@ async def get_channel_users(channel):
         
         # Create or connect to SQLite database
         db_file = os.path.join(channel_dir, f'{channel}_users.db')
-        conn = sqlite3.connect(db_file)
+        conn = open_users_db(db_file)
         c = conn.cursor()
         
-        # Create users table with additional fields
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                    (user_id INTEGER PRIMARY KEY,
-                     username TEXT,
-                     first_name TEXT,
-                     last_name TEXT,
-                     phone TEXT,
-                     is_bot BOOLEAN,
-                     is_verified BOOLEAN,
-                     is_restricted BOOLEAN,
-                     is_scam BOOLEAN,
-                     is_fake BOOLEAN,
-                     date_joined TIMESTAMP,
-                     status TEXT,
-                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        
         print(f"\nFetching users from {entity.title}")
         print(f"Channel ID: {channel}")
         